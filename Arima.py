@@ -1,41 +1,188 @@
+import json
+import os
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from statsmodels.stats.diagnostic import acorr_ljungbox
 from statsmodels.tsa.arima.model import ARIMA
+from statsmodels.tsa.stattools import adfuller
 import warnings
+from .Hierarchical_Forecast import hierarchical_forecast
+from .Instrumentation import instrumented
+from .Stage_Store import parquet_stage, save_parquet
 
 
-def arima_forecast_and_save(city_name, combined_data, output_dir='/content'):
+# Forecasting methods of arima_forecast_and_save
+forecast_methods = ('arima', 'hierarchical')
 
-    def grid_search_arima(train_data, p_values, d_values, q_values):
-        best_aic = float("inf")
-        best_order = None
-        best_model = None
 
-        for p in p_values:
-            for d in d_values:
+def _fit_order(train_data, order, steps=2, start_params=None):
+    """
+    Fits a single ARIMA order, or returns None if the fit fails.
+
+    Runs in worker processes, so it only returns plain values instead of the fitted model.
+
+    Returns:
+    - fit: Dict with the order, fitted parameters, AIC, number of observations, Ljung-Box p-value of the
+      residuals and the forecast for the next `steps` months, which is also the state kept between runs.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            model_fit = ARIMA(train_data, order=order).fit(start_params=start_params)
+        except Exception:
+            return None
+        forecast = model_fit.forecast(steps=steps).tolist()
+        try:
+            lags = max(1, min(3, len(train_data) // 3))
+            ljung_box_pvalue = float(acorr_ljungbox(model_fit.resid, lags=[lags])['lb_pvalue'].iloc[0])
+        except Exception:
+            ljung_box_pvalue = np.nan
+    return {
+        'order': list(order),
+        'params': model_fit.params.tolist(),
+        'aic': float(model_fit.aic),
+        'nobs': int(model_fit.nobs),
+        'ljung_box_pvalue': None if np.isnan(ljung_box_pvalue) else ljung_box_pvalue,
+        'forecast': forecast,
+    }
+
+
+def _select_best(fits):
+    """
+    Picks the best fit from (order, fit) pairs listed in grid order.
+
+    Only a strictly lower AIC replaces the current best, so ties resolve exactly like the serial grid search.
+
+    Returns:
+    - best_order: The order with the lowest AIC, or None if no order could be fitted.
+    - best_forecast: The forecast of the best order.
+    - best_fit: The fit of the best order (see _fit_order), kept as its state for the next run.
+    """
+    best_fit = None
+    for order, fit in fits:
+        if fit is not None and (best_fit is None or fit['aic'] < best_fit['aic']):
+            best_fit = fit
+    if best_fit is None:
+        return None, None, None
+    return tuple(best_fit['order']), np.asarray(best_fit['forecast']), best_fit
+
+
+def grid_search_arima(train_data, p_values, d_values, q_values, steps=2):
+    """
+    Serial exhaustive grid search over every (p, d, q) order.
+
+    Returns:
+    - best_order, best_forecast, best_fit: See _select_best.
+    """
+    orders = [(p, d, q) for p in p_values for d in d_values for q in q_values]
+    return _select_best((order, _fit_order(train_data, order, steps)) for order in orders)
+
+
+def pruned_grid_search_arima(train_data, p_values, d_values, q_values, steps=2, adf_alpha=0.05):
+    """
+    Grid search that skips d=0 for non-stationary series and stops once the AIC stops improving.
+
+    Orders are visited by increasing p + q for each d. When a whole complexity level brings no AIC
+    improvement, the remaining (larger) orders for that d are skipped.
+    """
+    d_values = list(d_values)
+    grid_position = {order: i for i, order in enumerate((p, d, q) for p in p_values for d in d_values for q in q_values)}
+
+    # Skip d=0 when the ADF test cannot reject a unit root
+    if 0 in d_values and len(d_values) > 1:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            try:
+                if adfuller(train_data, autolag='AIC')[1] > adf_alpha:
+                    d_values = [d for d in d_values if d != 0]
+            except Exception:
+                pass
+
+    fits = []
+    levels = sorted({p + q for p in p_values for q in q_values})
+    for d in d_values:
+        best_aic = float("inf")
+        for level in levels:
+            improved = False
+            for p in p_values:
                 for q in q_values:
-                    try:
-                        model = ARIMA(train_data, order=(p, d, q))
-                        model_fit = model.fit()
-                        aic = model_fit.aic
-                        if aic < best_aic:
-                            best_aic = aic
-                            best_order = (p, d, q)
-                            best_model = model_fit
-                    except Exception as e:
+                    if p + q != level:
                         continue
+                    fit = _fit_order(train_data, (p, d, q), steps)
+                    fits.append(((p, d, q), fit))
+                    if fit is not None and fit['aic'] < best_aic:
+                        best_aic = fit['aic']
+                        improved = True
+            if not improved:
+                break
 
-        return best_model, best_order
+    # Restore grid order before selecting so that ties resolve like the exhaustive search
+    fits.sort(key=lambda fit: grid_position[fit[0]])
+    return _select_best(fits)
 
-    # Prepare city data
+
+def _warm_start(train_data, previous, steps=2, aic_tolerance=2.0, ljung_box_alpha=0.05):
+    """
+    Refits the stored order of a neighbourhood from its stored parameters.
+
+    The fit is rejected, so the neighbourhood goes back to the grid search, when it fails, when its AIC rose
+    by more than `aic_tolerance` over the stored AIC scaled to the new number of observations, or when the
+    Ljung-Box test finds autocorrelation left in the residuals at `ljung_box_alpha`.
+
+    Returns:
+    - state: The new state (see _fit_order), or None if the fit was rejected.
+    """
+    state = _fit_order(train_data, tuple(previous['order']), steps, start_params=previous['params'])
+    if state is None:
+        return None
+    expected_aic = previous['aic'] * state['nobs'] / previous['nobs']
+    if state['aic'] - expected_aic > aic_tolerance:
+        return None
+    if state['ljung_box_pvalue'] is not None and state['ljung_box_pvalue'] < ljung_box_alpha:
+        return None
+    return state
+
+
+def load_arima_state(path, city_name):
+    """Returns the stored ARIMA state of every neighbourhood of a city, or an empty dict."""
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(city_name, {})
+
+
+def save_arima_state(path, city_name, state):
+    """Stores the ARIMA state of a city's neighbourhoods, keeping other cities in the same file."""
+    stored = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+    stored[city_name] = state
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(stored, f, indent=1)
+    os.replace(temporary_path, path)
+
+
+def _prepare_city_data(combined_data):
     city_data = combined_data.copy()
     city_data["date"] = pd.to_datetime(city_data["date"])
     city_data['price'] = pd.to_numeric(city_data['price'], downcast='float')
+    return city_data
 
-    unique_neighbourhoods = city_data['neighbourhood_cleansed'].dropna().unique()
-
-    results = []
 
-    for neighbourhood in unique_neighbourhoods:
+def _collect_train_series(city_name, city_data):
+    """
+    Returns a dict mapping every neighbourhood with enough data to its monthly average price in the training window.
+    """
+    train_series = {}
+    for neighbourhood in city_data['neighbourhood_cleansed'].dropna().unique():
         neighbourhood_data = city_data[city_data['neighbourhood_cleansed'] == neighbourhood]
         avg_prices = neighbourhood_data.groupby('date')['price'].mean()
         avg_prices.index = pd.to_datetime(avg_prices.index)
@@ -50,21 +197,218 @@ def arima_forecast_and_save(city_name, combined_data, output_dir='/content'):
             print(f"Skipping {neighbourhood} in {city_name} due to insufficient train data.")
             continue
 
-        p_values = range(0, 4)
-        d_values = range(0, 2)
-        q_values = range(0, 4)
+        train_series[neighbourhood] = train_part
+    return train_series
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            best_model, best_order = grid_search_arima(train_part, p_values, d_values, q_values)
 
-        if best_model is None:
+def _listing_weights(city_data):
+    """Share of the city's listings in every neighbourhood, or None without an 'id' column."""
+    if 'id' not in city_data.columns:
+        return None
+    listings = city_data.groupby('neighbourhood_cleansed', observed=True)['id'].nunique()
+    return listings / listings.sum()
+
+
+def forecast_neighbourhoods(train_series, method='arima', steps=2, n_jobs=1, prune=False, weights=None, state=None, estimator='ses'):
+    """
+    Forecasts the next `steps` months of every neighbourhood series.
+
+    Args:
+    - train_series: Dict mapping neighbourhood to its monthly average price Series.
+    - method: 'arima' grid-searches an ARIMA model per neighbourhood; 'hierarchical' fits all neighbourhoods
+      at once with batched exponential smoothing and reconciles them with the city level (see Hierarchical_Forecast).
+    - steps: Number of months to forecast.
+    - n_jobs: Number of worker processes used for the ARIMA fits. 1 runs serially, -1 uses all cores.
+    - prune: Use the pruned ARIMA grid search.
+    - weights: Weights of the neighbourhoods in the city aggregate of the hierarchical method.
+    - estimator: Base estimator of the hierarchical method, one of Hierarchical_Forecast.estimators
+      ('ses' or 'ar1'). Ignored by 'arima'.
+    - state: Optional dict of stored ARIMA states per neighbourhood (see load_arima_state). Neighbourhoods
+      with a state are warm-started from it and only grid-searched again when the fit degrades; the dict
+      is updated in place with the new state of every neighbourhood.
+
+    Returns:
+    - forecasts: Dict mapping neighbourhood to an array of `steps` forecasted prices.
+    """
+    if method == 'hierarchical':
+        forecasts, _ = hierarchical_forecast(train_series, steps=steps, estimator=estimator, weights=weights)
+        return forecasts
+    if method != 'arima':
+        raise ValueError(f"Unknown forecasting method: {method}. Choose one of {forecast_methods}")
+
+    p_values = range(0, 4)
+    d_values = range(0, 2)
+    q_values = range(0, 4)
+    orders = [(p, d, q) for p in p_values for d in d_values for q in q_values]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    def map_fits(function, arguments):
+        """Apply `function` to every neighbourhood's arguments, serially or over a process pool."""
+        if n_jobs == 1 or len(arguments) < 2:
+            return {neighbourhood: function(*args) for neighbourhood, args in arguments.items()}
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {neighbourhood: executor.submit(function, *args) for neighbourhood, args in arguments.items()}
+            return {neighbourhood: future.result() for neighbourhood, future in futures.items()}
+
+    # Warm-start the neighbourhoods with a stored state and keep the fits that did not degrade
+    warm_fits = {}
+    if state:
+        warm_fits = map_fits(_warm_start, {
+            neighbourhood: (train_part, state[neighbourhood], steps)
+            for neighbourhood, train_part in train_series.items() if neighbourhood in state
+        })
+        warm_fits = {neighbourhood: fit for neighbourhood, fit in warm_fits.items() if fit is not None}
+        print(f"Warm-started {len(warm_fits)} of {len(train_series)} neighbourhoods, "
+              f"grid-searching {len(train_series) - len(warm_fits)}")
+    searched_series = {neighbourhood: train_part for neighbourhood, train_part in train_series.items() if neighbourhood not in warm_fits}
+
+    # Fit the grid serially or spread it over a process pool
+    best_fits = {}
+    if n_jobs == 1:
+        for neighbourhood, train_part in searched_series.items():
+            if prune:
+                best_fits[neighbourhood] = pruned_grid_search_arima(train_part, p_values, d_values, q_values, steps)
+            else:
+                best_fits[neighbourhood] = grid_search_arima(train_part, p_values, d_values, q_values, steps)
+    elif searched_series:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            if prune:
+                # Pruning is sequential within a neighbourhood, so each neighbourhood is one task
+                futures = {
+                    neighbourhood: executor.submit(pruned_grid_search_arima, train_part, p_values, d_values, q_values, steps)
+                    for neighbourhood, train_part in searched_series.items()
+                }
+                best_fits = {neighbourhood: future.result() for neighbourhood, future in futures.items()}
+            else:
+                # Every (neighbourhood, order) pair is an independent task
+                futures = {
+                    neighbourhood: [(order, executor.submit(_fit_order, train_part, order, steps)) for order in orders]
+                    for neighbourhood, train_part in searched_series.items()
+                }
+                best_fits = {
+                    neighbourhood: _select_best((order, future.result()) for order, future in order_futures)
+                    for neighbourhood, order_futures in futures.items()
+                }
+
+    # Keep the fits of the orders found by the grid search for the next run
+    if state is not None:
+        state.update(warm_fits)
+        state.update({neighbourhood: best_fit for neighbourhood, (_, _, best_fit) in best_fits.items() if best_fit is not None})
+
+    forecasts = {}
+    for neighbourhood, train_part in train_series.items():
+        if neighbourhood in warm_fits:
+            forecasts[neighbourhood] = np.asarray(warm_fits[neighbourhood]['forecast'])
+            continue
+        best_order, forecasted_values, _ = best_fits[neighbourhood]
+
+        if best_order is None:
             fallback_model = ARIMA(train_part, order=(0, 1, 0))
             fallback_model_fit = fallback_model.fit()
-            forecasted_values = fallback_model_fit.forecast(steps=2)
-        else:
-            forecasted_values = best_model.forecast(steps=2)
+            forecasted_values = fallback_model_fit.forecast(steps=steps).to_numpy()
+
+        forecasts[neighbourhood] = forecasted_values
+    return forecasts
+
+
+@instrumented
+def backtest_forecast(city_name, combined_data, holdout=2, methods=forecast_methods, n_jobs=1, prune=False, estimator='ses'):
+    """
+    Compares the forecasting methods on the last `holdout` months of the training window.
+
+    Every method is fitted on the earlier months of each neighbourhood and scored against the held-out
+    average prices.
+
+    Args:
+    - city_name: Name of the city, used for logging.
+    - combined_data: The DataFrame containing 'neighbourhood_cleansed', 'date' and 'price' columns.
+    - holdout: Number of months held out at the end of every series.
+    - methods: Methods to compare, any of `forecast_methods`.
+    - n_jobs, prune: Passed to the ARIMA grid search.
+    - estimator: Base estimator of the hierarchical method, 'ses' or 'ar1'.
+
+    Returns:
+    - report: DataFrame with one row per method and its MAE, RMSE, MAPE and runtime in seconds.
+    """
+    city_data = _prepare_city_data(combined_data)
+    weights = _listing_weights(city_data)
+
+    train_series = {}
+    actuals = {}
+    for neighbourhood, series in _collect_train_series(city_name, city_data).items():
+        if len(series) - holdout < 6:
+            print(f"Skipping {neighbourhood} in {city_name} because fewer than 6 months remain before the holdout.")
+            continue
+        train_series[neighbourhood] = series.iloc[:-holdout]
+        actuals[neighbourhood] = series.iloc[-holdout:].to_numpy()
+
+    rows = []
+    for method in methods:
+        start = time.perf_counter()
+        forecasts = forecast_neighbourhoods(train_series, method, steps=holdout, n_jobs=n_jobs, prune=prune, weights=weights,
+                                            estimator=estimator)
+        elapsed = time.perf_counter() - start
+
+        actual = np.concatenate([actuals[neighbourhood] for neighbourhood in train_series]) if train_series else np.array([])
+        predicted = np.concatenate([forecasts[neighbourhood] for neighbourhood in train_series]) if train_series else np.array([])
+        errors = predicted - actual
+        rows.append({
+            'method': method,
+            'neighbourhoods': len(train_series),
+            'mae': np.abs(errors).mean() if len(errors) else np.nan,
+            'rmse': np.sqrt((errors ** 2).mean()) if len(errors) else np.nan,
+            'mape': (np.abs(errors) / np.abs(actual)).mean() * 100 if len(errors) else np.nan,
+            'seconds': elapsed,
+        })
+
+    report = pd.DataFrame(rows)
+    print(f"Backtest of {city_name} on {holdout} held-out months:")
+    print(report.to_string(index=False))
+    return report
+
+
+@instrumented
+@parquet_stage('final', inputs={'combined_data': 'previous'})
+def arima_forecast_and_save(city_name, combined_data, output_dir='/content', n_jobs=1, prune=False, output_formats=('csv', 'parquet'), method='arima',
+                            state_path=None, estimator='ses'):
+    """
+    Forecasts the average monthly price of every neighbourhood and saves the final data. Each neighbourhood
+    gets an ARIMA model, grid-searched or warm-started from the orders saved in `state_path`, unless
+    `method` is 'hierarchical'.
+
+    Args:
+    - city_name: Name of the city, used for logging and the output filename.
+    - combined_data: The DataFrame containing 'neighbourhood_cleansed', 'date' and 'price' columns.
+    - output_dir: Directory where the final data files are written.
+    - n_jobs: Number of worker processes used for the ARIMA fits. 1 runs serially, -1 uses all cores.
+    - prune: If True, skips d=0 for non-stationary series and stops the grid once the AIC stops improving.
+      The exhaustive default selects the same orders as the serial grid search.
+    - output_formats: Formats of the final data files, any of 'csv' and 'parquet'.
+    - method: 'arima' (default) or 'hierarchical', which fits all neighbourhoods at once with batched
+      exponential smoothing or AR(1) and reconciles them with the city mean price. Compare both with backtest_forecast.
+    - state_path: Optional JSON file keeping the chosen ARIMA order and parameters of every neighbourhood
+      between runs. Later runs warm-start from them and only grid-search neighbourhoods whose fit degraded.
+    - estimator: Base estimator of the hierarchical method, 'ses' (default) or 'ar1'.
+
+    Returns:
+    - final_combined_df: The city data with two forecasted months appended per neighbourhood.
+    """
+    # Prepare city data
+    city_data = _prepare_city_data(combined_data)
+
+    # Collect the training series of every neighbourhood before fitting anything
+    train_series = _collect_train_series(city_name, city_data)
+    state = load_arima_state(state_path, city_name) if state_path is not None and method == 'arima' else None
+    forecasts = forecast_neighbourhoods(train_series, method, n_jobs=n_jobs, prune=prune, weights=_listing_weights(city_data), state=state,
+                                        estimator=estimator)
+    if state is not None:
+        save_arima_state(state_path, city_name, state)
+
+    results = []
 
+    for neighbourhood, forecasted_values in forecasts.items():
         forecasted_values_df = pd.DataFrame({
             'neighbourhood_cleansed': [neighbourhood] * 2,
             'date': pd.date_range(start='2024-07-01', periods=2, freq='MS'),
@@ -85,12 +429,17 @@ def arima_forecast_and_save(city_name, combined_data, output_dir='/content'):
     # Sorting the final combined dataframe by neighbourhood and date
     final_combined_df = final_combined_df.sort_values(by=['neighbourhood_cleansed', 'date'])
 
-    # Save the updated combined_data back to the CSV file
-    output_file_path = f'{output_dir}/{city_name}_final_data.csv'
-    final_combined_df.to_csv(output_file_path, index=False)
-    print(f"Data saved to {output_file_path}")
+    # Save the updated combined_data as CSV and/or typed Parquet
+    if 'csv' in output_formats:
+        output_file_path = f'{output_dir}/{city_name}_final_data.csv'
+        final_combined_df.to_csv(output_file_path, index=False)
+        print(f"Data saved to {output_file_path}")
+    if 'parquet' in output_formats:
+        output_file_path = f'{output_dir}/{city_name}_final_data.parquet'
+        save_parquet(final_combined_df, output_file_path)
+        print(f"Data saved to {output_file_path}")
 
     # Display DataFrame information
     final_combined_df.info()
 
-    return final_combined_df
\ No newline at end of file
+    return final_combined_df
@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+from .Instrumentation import instrumented
+
+
+# Typed schema of every column the stages read or produce. Columns missing from a frame are ignored.
+int64_columns = ['id', 'listing_id', 'host_id']
+int32_columns = [
+    'number_of_reviews', 'number_of_reviews_ltm', 'calculated_host_listings_count', 'availability_365',
+    'host_total_listings_count', 'minimum_nights', 'maximum_nights',
+]
+float32_columns = ['price', 'reviews_per_month', 'review_scores_rating', 'sentiment_score', 'latitude', 'longitude']
+
+# Low-cardinality strings
+category_columns = [
+    'neighbourhood_cleansed', 'room_type', 'available', 'category', 'sentiment_label',
+    'Positivity_Score(1to5)', 'Customer_Positivity_Ranking(1to5)', 'top_amenities_with_percentages',
+]
+
+# Free text, one value per listing (or per review)
+text_columns = ['name', 'description', 'amenities', 'host_name', 'comments']
+
+# Text columns that belong to the listing and are stored once per listing next to per-month stages
+listing_text_columns = ['name', 'description', 'amenities', 'host_name']
+
+
+def _to_numeric(column):
+    """Parse a column as numbers, or return None if that would turn non-missing values into NaN."""
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        return column
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype(object)
+    numeric = pd.to_numeric(column, errors='coerce')
+    if numeric.notna().sum() != column.notna().sum():
+        return None
+    return numeric
+
+
+def _cast_integer(column, dtype):
+    numeric = _to_numeric(column)
+    if numeric is None:
+        return column
+    if pd.api.types.is_integer_dtype(numeric.dtype) and not numeric.hasnans:
+        return numeric.astype(dtype)
+    values = numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+    present = values[~np.isnan(values)]
+    if (present % 1 != 0).any():
+        return numeric.astype('float32')
+    # Nullable integers keep missing values, e.g. the ids of appended forecast rows
+    return numeric.astype(dtype.capitalize() if np.isnan(values).any() else dtype)
+
+
+@instrumented
+def apply_schema(df, text_dtype='category'):
+    """
+    Casts the known columns of a frame to compact dtypes.
+
+    - ids to int64, counts to int32 and measures to float32 (nullable Int64/Int32 when values are missing),
+    - low-cardinality strings to category,
+    - free text to `text_dtype`: 'category' for frames repeating each listing once per month, so every
+      distinct text is stored once, or 'string[pyarrow]' for frames with one row per listing.
+
+    Numeric casts are skipped for columns that do not parse cleanly, e.g. raw '$1,234.00' prices.
+
+    Args:
+    - df: The DataFrame to cast. It is not modified.
+    - text_dtype: dtype of the free text columns.
+
+    Returns:
+    - df: A DataFrame with the cast columns.
+    """
+    casts = {}
+    for col in df.columns:
+        column = df[col]
+        if col in int64_columns:
+            casts[col] = _cast_integer(column, 'int64')
+        elif col in int32_columns:
+            casts[col] = _cast_integer(column, 'int32')
+        elif col in float32_columns:
+            numeric = _to_numeric(column)
+            if numeric is not None:
+                casts[col] = numeric.astype('float32')
+        elif col in category_columns or col in text_columns:
+            dtype = text_dtype if col in text_columns else 'category'
+            if column.dtype != dtype:
+                try:
+                    casts[col] = column.astype(dtype)
+                except TypeError:
+                    # Unhashable values such as parsed lists stay as they are
+                    pass
+
+    changed = {col: values for col, values in casts.items() if values.dtype != df[col].dtype}
+    return df.assign(**changed) if changed else df
+
+
+@instrumented
+def memory_report(df, stage=None):
+    """
+    Returns the deep memory usage of every column, largest first, and prints the total.
+
+    Returns:
+    - report: DataFrame with 'column', 'dtype' and 'memory_mb' columns.
+    """
+    usage = df.memory_usage(deep=True, index=False) / 1024 ** 2
+    report = pd.DataFrame({
+        'column': usage.index,
+        'dtype': [str(df[col].dtype) for col in usage.index],
+        'memory_mb': usage.to_numpy(),
+    }).sort_values('memory_mb', ascending=False, ignore_index=True)
+    label = f"Stage '{stage}'" if stage else "DataFrame"
+    print(f"{label}: {len(df)} rows, {report['memory_mb'].sum():.1f} MB")
+    return report
+
+
+def split_listing_text(df, columns=listing_text_columns):
+    """
+    Moves the listing text columns of a per-month frame to a side table with one row per listing.
+
+    Args:
+    - df: DataFrame with an 'id' column and one row per listing and month.
+    - columns: Text columns that only depend on the listing.
+
+    Returns:
+    - df: The frame without the text columns.
+    - listing_text: DataFrame with 'id' and the text columns, one row per listing, or None if the frame
+      has no such columns.
+    """
+    columns = [col for col in columns if col in df.columns]
+    if 'id' not in df.columns or not columns:
+        return df, None
+    first_rows = df['id'].notna() & ~df['id'].duplicated()
+    listing_text = df.loc[first_rows, ['id'] + columns].reset_index(drop=True)
+    listing_text = apply_schema(listing_text, text_dtype='string[pyarrow]')
+    return df.drop(columns=columns), listing_text
+
+
+def attach_listing_text(df, listing_text):
+    """
+    Adds the columns of a listing text side table back to a per-month frame.
+
+    Every column becomes a categorical whose categories are the distinct texts, so no text is repeated per row.
+    """
+    positions = pd.Index(listing_text['id']).get_indexer(df['id'])
+    attached = {}
+    for col in listing_text.columns.drop('id'):
+        codes, uniques = pd.factorize(listing_text[col])
+        row_codes = np.full(len(df), -1, dtype=codes.dtype)
+        row_codes[positions >= 0] = codes[positions[positions >= 0]]
+        attached[col] = pd.Categorical.from_codes(row_codes, categories=pd.Index(uniques, dtype=object))
+    return df.assign(**attached)
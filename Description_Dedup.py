@@ -0,0 +1,190 @@
+import re
+import numpy as np
+import pandas as pd
+
+
+# Normalization: markup, punctuation and the numbers of units and floors do not tell descriptions apart,
+# other numbers (bedrooms, guests, minutes to the beach) do and are kept
+markup_pattern = re.compile(r'<[^>]*>')
+unit_number_pattern = re.compile(r'\b(unit|apartment|apt|flat|floor|suite|room)\.?\s*(?:#|no\.?|number)?\s*\d+[a-z]?\b|#\s*\d+[a-z]?\b')
+floor_ordinal_pattern = re.compile(r'\b\d+(?:st|nd|rd|th)\s+(floor)\b')
+punctuation_pattern = re.compile(r'[^\w\s#]')
+
+# Prime modulus of the MinHash permutations, below 2**31 so that a * x + b fits in uint64
+minhash_prime = np.uint64((1 << 31) - 1)
+
+
+def normalize_description(text):
+    """
+    Lowercases a description, masks unit, apartment, floor and '#' numbers (e.g. 'unit 4b', 'apt #12', '3rd floor')
+    and drops markup, punctuation and repeated whitespace. Other numbers are kept.
+    """
+    text = markup_pattern.sub(' ', str(text).lower())
+    text = unit_number_pattern.sub(lambda match: f"{match.group(1) or ''} #", text)
+    text = floor_ordinal_pattern.sub(r'# \1', text)
+    text = punctuation_pattern.sub(' ', text)
+    return ' '.join(text.split())
+
+
+def _shingle_hashes(normalized, shingle_size=3):
+    """
+    Hashes the word shingles of every text.
+
+    Returns:
+    - hashes: uint64 array with one hash per shingle, reduced modulo `minhash_prime`.
+    - owners: Index of the text of every shingle, in increasing order.
+    """
+    words = pd.Series(normalized, dtype=object).str.split().explode()
+    owners = words.index.to_numpy(dtype='int64')
+    word_ids = pd.factorize(words.fillna(''))[0].astype('uint64') + np.uint64(1)
+
+    # Shingle j combines words j .. j + shingle_size - 1 of the same text
+    hashes = word_ids.copy()
+    valid = np.ones(len(word_ids), dtype=bool)
+    for offset in range(1, shingle_size):
+        shifted = np.zeros(len(word_ids), dtype='uint64')
+        shifted[:len(word_ids) - offset] = word_ids[offset:]
+        same_text = np.zeros(len(word_ids), dtype=bool)
+        same_text[:len(word_ids) - offset] = owners[offset:] == owners[:len(owners) - offset]
+        with np.errstate(over='ignore'):
+            hashes = hashes * np.uint64(1_000_003) + shifted
+        valid &= same_text
+
+    # Texts shorter than one shingle keep their single words instead
+    has_shingle = np.zeros(len(normalized), dtype=bool)
+    has_shingle[owners[valid]] = True
+    keep = valid | ~has_shingle[owners]
+    hashes = np.where(valid, hashes, word_ids)[keep] % minhash_prime
+    return hashes, owners[keep]
+
+
+def minhash_signatures(normalized, num_perm=64, shingle_size=3, seed=0, block_size=100_000):
+    """
+    MinHash signatures of texts over their word shingles, computed in numpy blocks of about `block_size` shingles.
+
+    Returns:
+    - signatures: uint64 array of shape (len(normalized), num_perm). Texts without words get an all-zero signature.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(minhash_prime), size=num_perm).astype('uint64')
+    b = rng.integers(0, int(minhash_prime), size=num_perm).astype('uint64')
+
+    hashes, owners = _shingle_hashes(normalized, shingle_size)
+    signatures = np.zeros((len(normalized), num_perm), dtype='uint64')
+    if len(hashes) == 0:
+        return signatures
+
+    # Each block holds whole texts, so one reduceat per block gives the minimum of every text
+    text_ids, starts = np.unique(owners, return_index=True)
+    ends = np.append(starts[1:], len(hashes))
+    block_start = 0
+    while block_start < len(text_ids):
+        block_end = max(np.searchsorted(ends, starts[block_start] + block_size, side='right'), block_start + 1)
+        first, last = starts[block_start], ends[block_end - 1]
+        values = (hashes[first:last, None] * a + b) % minhash_prime
+        signatures[text_ids[block_start:block_end]] = np.minimum.reduceat(values, starts[block_start:block_end] - first, axis=0)
+        block_start = block_end
+    return signatures
+
+
+def lsh_bands(num_perm, threshold):
+    """Number of bands and rows per band whose LSH similarity threshold (1 / bands) ** (1 / rows) is closest to `threshold`."""
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(candidates, key=lambda band: abs((1 / band[0]) ** (1 / band[1]) - threshold))
+
+
+def _union_find_roots(size, edges):
+    """Connected components of `edges`, rooted at the smallest index of every component."""
+    parent = np.arange(size)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in edges:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(size)], dtype='int64')
+
+
+def cluster_near_duplicates(normalized, threshold=0.9, num_perm=64, seed=0):
+    """
+    Clusters texts whose estimated Jaccard similarity over word shingles reaches `threshold`.
+
+    Candidates come from MinHash LSH buckets; a text joins the first text of its bucket only when their
+    signatures agree on at least `threshold` of the permutations.
+
+    Returns:
+    - roots: For every text, the index of the first text of its cluster.
+    """
+    signatures = minhash_signatures(normalized, num_perm=num_perm, seed=seed)
+    bands, rows = lsh_bands(num_perm, threshold)
+
+    edges = []
+    for band in range(bands):
+        # Combine the rows of the band into one bucket key; colliding keys are caught by the check below
+        keys = np.zeros(len(signatures), dtype='uint64')
+        with np.errstate(over='ignore'):
+            for column in range(band * rows, (band + 1) * rows):
+                keys = keys * np.uint64(1_000_003) + signatures[:, column]
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        leaders = first[inverse]
+        candidates = np.flatnonzero(leaders != np.arange(len(keys)))
+        similarity = (signatures[candidates] == signatures[leaders[candidates]]).mean(axis=1)
+        accepted = candidates[similarity >= threshold]
+        edges.extend(zip(accepted.tolist(), leaders[accepted].tolist()))
+
+    return _union_find_roots(len(normalized), edges)
+
+
+def deduplicate_texts(texts, threshold=0.9, num_perm=64, seed=0):
+    """
+    Picks one representative per cluster of near-duplicate texts, so that models only run on the representatives.
+
+    Texts are first normalized (see normalize_description), which merges the ones differing only in unit or floor
+    numbers, markup, punctuation or whitespace, then near-duplicates are clustered with MinHash LSH.
+
+    Args:
+    - texts: Sequence of distinct texts, e.g. the unique descriptions of a city.
+    - threshold: Minimum estimated Jaccard similarity of the word 3-shingles of two texts in one cluster.
+      1.0 only merges texts that are identical after normalization.
+    - num_perm: Number of MinHash permutations.
+    - seed: Random seed of the permutations.
+
+    Returns:
+    - representatives: List with the first text of every cluster.
+    - owners: int64 array giving, for every text, the index of its representative.
+    - report: Dict with the number of texts, exact and near duplicates and the fraction of inference saved.
+    """
+    texts = list(texts)
+    normalized = [normalize_description(text) for text in texts]
+    codes, unique_normalized = pd.factorize(pd.Series(normalized, dtype=object))
+
+    if threshold >= 1.0:
+        roots = np.arange(len(unique_normalized))
+    else:
+        roots = cluster_near_duplicates(list(unique_normalized), threshold, num_perm, seed)
+
+    # The representative of a cluster is the first original text of its first normalized text
+    cluster_roots, owners = np.unique(roots[codes], return_inverse=True)
+    first_text = np.unique(codes, return_index=True)[1]
+    representatives = [texts[first_text[root]] for root in cluster_roots]
+
+    text_characters = sum(len(str(text)) for text in texts)
+    report = {
+        'texts': len(texts),
+        'representatives': len(representatives),
+        'exact_duplicates': len(texts) - len(unique_normalized),
+        'near_duplicates': len(unique_normalized) - len(representatives),
+        'inference_saved': 1 - len(representatives) / len(texts) if texts else 0.0,
+        'characters_saved': 1 - sum(len(str(text)) for text in representatives) / text_characters if text_characters else 0.0,
+    }
+    print(f"Description dedup at threshold {threshold}: {report['texts']} texts, {report['representatives']} representatives "
+          f"({report['exact_duplicates']} duplicates after normalization, {report['near_duplicates']} near duplicates), "
+          f"{report['inference_saved']:.1%} of inference saved")
+    return representatives, owners.astype('int64'), report
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+
+estimators = ("ses", "ar1")
+
+# Grid of smoothing parameters tried for every series at once
+ses_alphas = np.linspace(0.05, 1.0, 20)
+
+
+def price_matrix(train_series):
+    """
+    Stacks the monthly series of every neighbourhood into one (neighbourhood x month) matrix.
+
+    Args:
+    - train_series: Dict mapping neighbourhood to a monthly price Series indexed by date.
+
+    Returns:
+    - neighbourhoods: List of neighbourhoods, one per matrix row.
+    - months: DatetimeIndex of the matrix columns (union of all series dates).
+    - values: float64 array with NaN for the months a neighbourhood has no price.
+    """
+    frame = pd.DataFrame({neighbourhood: series for neighbourhood, series in train_series.items()}).T
+    frame = frame.reindex(columns=frame.columns.sort_values())
+    return list(frame.index), frame.columns, frame.to_numpy(dtype=np.float64)
+
+
+def _first_valid(values):
+    return values[np.arange(len(values)), np.argmax(~np.isnan(values), axis=1)]
+
+
+def _last_valid(values):
+    last = values.shape[1] - 1 - np.argmax(~np.isnan(values[:, ::-1]), axis=1)
+    return values[np.arange(len(values)), last]
+
+
+def fit_ses(values, alphas=ses_alphas):
+    """
+    Fits simple exponential smoothing to every row, trying every alpha for all rows in one pass over the months.
+
+    Missing months leave the level unchanged.
+
+    Returns:
+    - alpha: The alpha with the lowest one-step-ahead squared error of each row.
+    - level: The final smoothed level of each row, which is also its flat forecast.
+    """
+    level = np.repeat(_first_valid(values)[:, None], len(alphas), axis=1)
+    sse = np.zeros_like(level)
+    for t in range(values.shape[1]):
+        y = values[:, t][:, None]
+        error = np.where(np.isnan(y), 0.0, y - level)
+        sse += error ** 2
+        level = level + alphas * error
+
+    best = sse.argmin(axis=1)
+    rows = np.arange(len(values))
+    return alphas[best], level[rows, best]
+
+
+def fit_ar1(values):
+    """
+    Fits y[t] = intercept + phi * y[t-1] to every row by least squares, solving the normal equations of all
+    rows at once. Pairs with a missing month are left out.
+
+    Rows with fewer than two usable pairs, or no variation, fall back to their mean (phi = 0). phi is
+    clipped to [-0.99, 0.99] to keep the forecasts stable.
+
+    Returns:
+    - intercept: Array with the intercept of each row.
+    - phi: Array with the autoregressive coefficient of each row.
+    """
+    previous, current = values[:, :-1], values[:, 1:]
+    mask = ~np.isnan(previous) & ~np.isnan(current)
+    pairs = mask.sum(axis=1)
+
+    mean_previous = np.where(mask, previous, 0.0).sum(axis=1) / np.maximum(pairs, 1)
+    mean_current = np.where(mask, current, 0.0).sum(axis=1) / np.maximum(pairs, 1)
+    centered_previous = np.where(mask, previous - mean_previous[:, None], 0.0)
+    centered_current = np.where(mask, current - mean_current[:, None], 0.0)
+    sxx = (centered_previous ** 2).sum(axis=1)
+    sxy = (centered_previous * centered_current).sum(axis=1)
+
+    usable = (pairs >= 2) & (sxx > 0)
+    phi = np.clip(np.divide(sxy, sxx, out=np.zeros_like(sxx), where=usable), -0.99, 0.99)
+    intercept = np.where(usable, mean_current - phi * mean_previous, np.nanmean(values, axis=1))
+    return intercept, phi
+
+
+def forecast_rows(values, estimator="ses", steps=2):
+    """
+    Forecasts the next `steps` months of every row of a (series x month) matrix.
+
+    Returns:
+    - forecasts: Array of shape (rows, steps).
+    """
+    if estimator == "ses":
+        _, level = fit_ses(values)
+        return np.repeat(level[:, None], steps, axis=1)
+
+    if estimator == "ar1":
+        intercept, phi = fit_ar1(values)
+        forecasts = np.empty((len(values), steps))
+        y = _last_valid(values)
+        for h in range(steps):
+            y = intercept + phi * y
+            forecasts[:, h] = y
+        return forecasts
+
+    raise ValueError(f"Unknown estimator: {estimator}. Choose one of {estimators}")
+
+
+def reconcile(base_forecasts, city_forecast, weights):
+    """
+    OLS reconciliation of neighbourhood forecasts with a city-level forecast.
+
+    The hierarchy is city = weights @ neighbourhoods. Projecting the stacked base forecasts onto it gives
+    b + w * (c - w @ b) / (1 + w @ w), so the reconciled neighbourhoods aggregate exactly to the
+    reconciled city forecast.
+
+    Args:
+    - base_forecasts: Array of shape (neighbourhoods, steps).
+    - city_forecast: Array of shape (steps,).
+    - weights: Array of shape (neighbourhoods,).
+
+    Returns:
+    - neighbourhood_forecasts: Reconciled array of shape (neighbourhoods, steps).
+    - city_forecast: Reconciled city forecast, equal to weights @ neighbourhood_forecasts.
+    """
+    gap = (city_forecast - weights @ base_forecasts) / (1.0 + weights @ weights)
+    neighbourhood_forecasts = base_forecasts + np.outer(weights, gap)
+    return neighbourhood_forecasts, weights @ neighbourhood_forecasts
+
+
+def hierarchical_forecast(train_series, steps=2, estimator="ses", weights=None):
+    """
+    Forecasts every neighbourhood of a city at once and reconciles them with a city-level forecast.
+
+    Args:
+    - train_series: Dict mapping neighbourhood to a monthly price Series indexed by date.
+    - steps: Number of months to forecast.
+    - estimator: "ses" (simple exponential smoothing) or "ar1".
+    - weights: Optional dict or Series mapping neighbourhood to its weight in the city aggregate, e.g. its
+      share of listings so that the city level is the city mean price. Defaults to a plain sum.
+
+    Returns:
+    - forecasts: Dict mapping neighbourhood to an array of `steps` forecasted prices.
+    - city_forecast: Array with the reconciled city-level forecast.
+    """
+    if not train_series:
+        return {}, np.zeros(steps)
+
+    neighbourhoods, _, values = price_matrix(train_series)
+    if weights is None:
+        weights = np.ones(len(neighbourhoods))
+    else:
+        weights = np.asarray([weights.get(neighbourhood, 0.0) for neighbourhood in neighbourhoods], dtype=np.float64)
+
+    # City-level series, with gaps of a neighbourhood filled from its neighbouring months
+    filled = pd.DataFrame(values).ffill(axis=1).bfill(axis=1).to_numpy()
+    city_values = (weights @ filled)[None, :]
+
+    base_forecasts = forecast_rows(values, estimator, steps)
+    city_base = forecast_rows(city_values, estimator, steps)[0]
+    neighbourhood_forecasts, city_forecast = reconcile(base_forecasts, city_base, weights)
+
+    forecasts = dict(zip(neighbourhoods, neighbourhood_forecasts))
+    return forecasts, city_forecast
@@ -0,0 +1,176 @@
+import os
+import pandas as pd
+from .Arima import arima_forecast_and_save
+from .Instrumentation import instrumented
+from .Merge_Listings_Calendar_Data import prepare_combined_data, reviews_per_month_fill_value
+from .Process_Calendar_Data import process_city_calender
+from .Process_Listing_Data import process_city_listings
+from .Processing_Amenities import process_combined_data
+from .Sentiment_Analysis_Description import analyze_sentiment
+from .Sentiment_Analysis_Reviews import process_city_reviews, review_columns, review_end_date, review_start_date
+from .Stage_Store import has_stage, load_parquet, load_stage, save_parquet
+from .Zero_Shot_Classification import classify_property_descriptions
+
+
+# Listing columns whose changes require a listing to be reprocessed
+fingerprint_listing_columns = ['description', 'amenities', 'price']
+
+# Calendar columns whose changes require a listing to be reprocessed
+fingerprint_calendar_columns = ['date', 'available', 'price']
+
+# Columns computed per neighbourhood, which are recomputed on the spliced dataset
+neighbourhood_columns = ['amenities_list', 'top_amenities_with_percentages']
+
+
+def compute_review_hashes(city_name, dataset_dir, start_date=review_start_date, end_date=review_end_date, chunksize=500_000):
+    """
+    Hashes the reviews of every listing in the date range scored by process_city_reviews, so that
+    new, edited or removed reviews change the listing's fingerprint.
+
+    Returns:
+    - review_hashes: uint64 Series indexed by listing id, the sum of the hashes of its review rows.
+    """
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    hashes = []
+    for i in range(1, 5):
+        file_path = os.path.join(dataset_dir, f"{city_name}_reviews{i}.csv")
+        for chunk in pd.read_csv(file_path, usecols=review_columns, dtype={'listing_id': 'Int64'}, chunksize=chunksize):
+            dates = pd.to_datetime(chunk['date'], errors='coerce')
+            chunk = chunk[(dates >= start_date) & (dates <= end_date) & chunk['listing_id'].notna()]
+            row_hashes = pd.util.hash_pandas_object(chunk[review_columns], index=False)
+            hashes.append(row_hashes.groupby(chunk['listing_id'].to_numpy(dtype='int64')).sum())
+
+    # Sum the per-chunk sums in uint64, wrapping around like the row sums
+    return pd.concat(hashes).groupby(level=0).sum() if hashes else pd.Series(dtype='uint64')
+
+
+def compute_listing_fingerprints(combined_calender, combined_listings_extended, review_hashes=None):
+    """
+    Computes one fingerprint per listing from its description, amenities, price, calendar rows and,
+    optionally, its reviews.
+
+    Row hashes are combined with a sum, so the fingerprint does not depend on row order.
+
+    Args:
+    - combined_calender: Output of process_city_calender.
+    - combined_listings_extended: Output of process_city_listings.
+    - review_hashes: Optional output of compute_review_hashes; reviews of unknown listings are ignored.
+
+    Returns:
+    - fingerprints: DataFrame with 'id' and uint64 'fingerprint' columns.
+    """
+    listing_columns = [col for col in fingerprint_listing_columns if col in combined_listings_extended.columns]
+    listing_hashes = pd.util.hash_pandas_object(combined_listings_extended[listing_columns], index=False)
+    listing_hashes = listing_hashes.groupby(combined_listings_extended['id'].to_numpy()).sum()
+
+    calendar_columns = [col for col in fingerprint_calendar_columns if col in combined_calender.columns]
+    calendar_hashes = pd.util.hash_pandas_object(combined_calender[calendar_columns], index=False)
+    calendar_hashes = calendar_hashes.groupby(combined_calender['listing_id'].to_numpy()).sum()
+
+    # Mix both parts so that a change on either side changes the fingerprint
+    parts = pd.DataFrame({'listing': listing_hashes, 'calendar': calendar_hashes})
+    if review_hashes is not None:
+        parts['reviews'] = review_hashes
+    parts = parts.fillna(0).astype('uint64')
+    fingerprints = pd.util.hash_pandas_object(parts, index=False)
+
+    return pd.DataFrame({'id': parts.index.astype('int64'), 'fingerprint': fingerprints.to_numpy()})
+
+
+def diff_fingerprints(previous_fingerprints, fingerprints):
+    """
+    Compares two fingerprint tables.
+
+    Returns:
+    - changed_ids: Set of ids that are new or whose fingerprint changed.
+    - removed_ids: Set of ids that are no longer present.
+    """
+    merged = pd.merge(previous_fingerprints, fingerprints, on='id', how='outer', suffixes=('_previous', ''), indicator=True)
+    changed = (merged['_merge'] == 'right_only') | (
+        (merged['_merge'] == 'both') & (merged['fingerprint_previous'] != merged['fingerprint'])
+    )
+    changed_ids = set(merged.loc[changed, 'id'].astype('int64'))
+    removed_ids = set(merged.loc[merged['_merge'] == 'left_only', 'id'].astype('int64'))
+    return changed_ids, removed_ids
+
+
+@instrumented
+def refresh_city(city_name, workdir, dataset_dir='/content', output_dir=None, previous_final=None,
+                 include_reviews=None, cache=None, n_jobs=1):
+    """
+    Refreshes a city's final dataset, reprocessing only the listings whose source rows changed. With
+    review rankings, a listing whose reviews in the scored date range changed counts as changed too.
+
+    Calendar and listings files are always parsed (they are needed for the diff), but the model-bound
+    stages only see new or changed listings. Their rows are spliced into the previous final dataset,
+    after which the neighbourhood-level amenities and the ARIMA forecasts are recomputed.
+
+    Args:
+    - city_name: Name of the city to refresh.
+    - workdir: Per-city work directory holding 'fingerprints.parquet' and the previous 'final' stage.
+    - dataset_dir: Directory containing the new CSV snapshots.
+    - output_dir: Directory where the final data files are written. Defaults to `workdir`.
+    - previous_final: Previous final dataset. If None, it is loaded from the 'final' stage in `workdir`.
+    - include_reviews: Whether to rerun review sentiment for changed listings. Defaults to whether the
+      previous final dataset has review rankings.
+    - cache: Optional InferenceCache (or path to one) passed to the NLP stages.
+    - n_jobs: Number of worker processes used for the ARIMA fits.
+
+    Returns:
+    - final_combined_df: The refreshed final dataset.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    output_dir = output_dir or workdir
+    fingerprints_path = os.path.join(workdir, 'fingerprints.parquet')
+
+    if previous_final is None and has_stage(workdir, 'final'):
+        previous_final = load_stage(workdir, 'final')
+    if include_reviews is None:
+        include_reviews = previous_final is not None and 'Customer_Positivity_Ranking(1to5)' in previous_final.columns
+
+    combined_calender = process_city_calender(city_name, dataset_dir)
+    combined_listings_extended = process_city_listings(city_name, dataset_dir)
+    review_hashes = compute_review_hashes(city_name, dataset_dir) if include_reviews else None
+    fingerprints = compute_listing_fingerprints(combined_calender, combined_listings_extended, review_hashes)
+
+    # Without a previous run every listing counts as new
+    if previous_final is None or not os.path.exists(fingerprints_path):
+        previous_fingerprints = fingerprints.iloc[:0]
+        previous_final = None
+    else:
+        previous_fingerprints = load_parquet(fingerprints_path)
+
+    changed_ids, removed_ids = diff_fingerprints(previous_fingerprints, fingerprints)
+    print(f"Listings in {city_name}: {len(fingerprints)}, changed or new: {len(changed_ids)}, removed: {len(removed_ids)}")
+
+    # Run the per-listing stages on the changed listings only
+    changed_calender = combined_calender[combined_calender['listing_id'].isin(changed_ids)]
+    changed_listings = combined_listings_extended[combined_listings_extended['id'].isin(changed_ids)]
+    changed_data = prepare_combined_data(changed_calender, changed_listings,
+                                         reviews_per_month_mean=reviews_per_month_fill_value(combined_calender, combined_listings_extended))
+    if len(changed_data) > 0:
+        changed_data = classify_property_descriptions(changed_data, cache=cache)
+        changed_data = analyze_sentiment(changed_data, cache=cache)
+        if include_reviews:
+            changed_data = process_city_reviews(changed_data, city_name, dataset_dir=dataset_dir, cache=cache)
+
+    # Splice the new rows into the previous listing rows, dropping forecasts and neighbourhood-level columns
+    if previous_final is not None:
+        kept_data = previous_final[previous_final['id'].notna()]
+        kept_data = kept_data[~kept_data['id'].isin(changed_ids | removed_ids)]
+        kept_data = kept_data.drop(columns=neighbourhood_columns, errors='ignore')
+        kept_data = kept_data.astype({'id': 'int64'})
+        combined_data = pd.concat([kept_data, changed_data], ignore_index=True)
+    else:
+        combined_data = changed_data
+    print(f"Rows reused from the previous run: {len(combined_data) - len(changed_data)}, recomputed: {len(changed_data)}")
+
+    # Recompute the neighbourhood-level stages on the whole city
+    combined_data = process_combined_data(combined_data)
+    final_combined_df = arima_forecast_and_save(city_name, combined_data, output_dir=output_dir, n_jobs=n_jobs,
+                                                state_path=os.path.join(workdir, 'arima_state.json'), workdir=workdir)
+
+    # Keep the fingerprints for the next refresh
+    save_parquet(fingerprints, fingerprints_path)
+
+    return final_combined_df
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class InferenceCache:
+    """
+    Persistent, content-addressed cache for transformer inference results.
+
+    Results are stored in a SQLite file keyed by a hash of (model name, task, candidate labels, text),
+    so unchanged listings and reviews are never sent through the models twice. The cache keeps at most
+    `max_entries` results and evicts the least recently used ones beyond that.
+
+    Args:
+    - path: Location of the SQLite file.
+    - max_entries: Maximum number of cached results kept on disk.
+    """
+
+    def __init__(self, path='/content/inference_cache.sqlite', max_entries=2_000_000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(model_name, task, text, candidate_labels=None):
+        """Build the content address of one inference result."""
+        labels = json.dumps(list(candidate_labels)) if candidate_labels is not None else ''
+        payload = '\x1f'.join([model_name, task, labels, text])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys, chunk_size=500):
+        """Return a dict with the cached results of the given keys, refreshing their last-used time."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f'SELECT key, result FROM results WHERE key IN ({placeholders})', chunk
+                ).fetchall()
+                found.update((key, json.loads(result)) for key, result in rows)
+                self._connection.executemany(
+                    'UPDATE results SET last_used = ? WHERE key = ?', [(now, key) for key, _ in rows]
+                )
+            self._connection.commit()
+        return found
+
+    def put_many(self, items):
+        """Store a dict of key -> result and evict the oldest entries if the cache grew too large."""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO results (key, result, last_used) VALUES (?, ?, ?)',
+                [(key, json.dumps(result), now) for key, result in items.items()]
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        count = self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def cached_map(self, texts, compute, model_name, task, candidate_labels=None):
+        """
+        Return one result per text, running `compute` only on texts that are not cached yet.
+
+        Args:
+        - texts: List of input texts.
+        - compute: Function taking a list of texts and returning a list of results in the same order.
+        - model_name, task, candidate_labels: Parts of the cache key besides the text itself.
+
+        Returns:
+        - results: List of results aligned with `texts`.
+        """
+        keys = [self.make_key(model_name, task, text, candidate_labels) for text in texts]
+        found = self.get_many(list(set(keys)))
+
+        # Send every missing text through the model exactly once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += len(missing)
+
+        if missing:
+            computed = dict(zip(missing.keys(), compute(list(missing.values()))))
+            self.put_many(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def stats(self):
+        """Return the hit/miss counters and the number of stored results."""
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_inference_cache(cache):
+    """Accept None, a path to a SQLite file or an InferenceCache and return an InferenceCache or None."""
+    if cache is None or isinstance(cache, InferenceCache):
+        return cache
+    return InferenceCache(cache)
@@ -0,0 +1,246 @@
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Settings are kept in environment variables so that worker processes started by the orchestrator inherit them
+log_env = 'AIRBNB_BACKEND_PROFILE_LOG'
+profiler_env = 'AIRBNB_BACKEND_PROFILER'
+profile_dir_env = 'AIRBNB_BACKEND_PROFILE_DIR'
+
+profilers = ('cprofile', 'pyinstrument')
+
+_log_path = os.environ.get(log_env) or None
+_profiler = os.environ.get(profiler_env) or None
+_profile_dir = os.environ.get(profile_dir_env) or None
+_write_lock = threading.Lock()
+_local = threading.local()
+
+# Outermost instrumented calls running in any thread of this process, and how many have started so far
+_active_lock = threading.Lock()
+_active_calls = 0
+_started_calls = 0
+
+
+def enable_instrumentation(log_path, profiler=None, profile_dir=None):
+    """
+    Start recording every instrumented call to a JSON-lines log.
+
+    Args:
+    - log_path: File the records are appended to, one JSON object per call.
+    - profiler: Optional 'cprofile' or 'pyinstrument'; profiles every outermost instrumented call.
+    - profile_dir: Directory for the profiler output files. Defaults to the directory of the log.
+    """
+    global _log_path, _profiler, _profile_dir
+    if profiler is not None and profiler not in profilers:
+        raise ValueError(f"Unknown profiler: {profiler}. Choose one of {profilers}")
+    _log_path = os.path.abspath(log_path)
+    _profiler = profiler
+    _profile_dir = profile_dir or os.path.dirname(_log_path)
+    os.environ[log_env] = _log_path
+    os.environ[profiler_env] = profiler or ''
+    os.environ[profile_dir_env] = _profile_dir
+
+
+def disable_instrumentation():
+    global _log_path, _profiler, _profile_dir
+    _log_path = _profiler = _profile_dir = None
+    for name in (log_env, profiler_env, profile_dir_env):
+        os.environ.pop(name, None)
+
+
+def instrumentation_enabled():
+    """Whether instrumented calls are currently being recorded."""
+    return _log_path is not None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of the whole process where the kernel supports it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _count_rows(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        counts = [len(item) for item in value if isinstance(item, pd.DataFrame)]
+        return sum(counts) if counts else None
+    return None
+
+
+def _city(city_parameter, parameters, args, kwargs):
+    if city_parameter is None:
+        return None
+    if city_parameter in kwargs:
+        return kwargs[city_parameter]
+    position = parameters.index(city_parameter)
+    return args[position] if position < len(args) else None
+
+
+def _model_items():
+    """Total number of items processed by the loaded pipelines, if the model registry is in use."""
+    registry = sys.modules.get(f"{__package__}.Model_Registry")
+    if registry is None:
+        return 0
+    return sum(stats['items'] for stats in registry.model_stats())
+
+
+def _start_profiler(name):
+    if _profiler == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if _profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError as e:
+            raise ImportError("The 'pyinstrument' profiler requires pyinstrument: pip install pyinstrument") from e
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+
+def _save_profile(profiler, name):
+    os.makedirs(_profile_dir, exist_ok=True)
+    base_path = os.path.join(_profile_dir, f"{name}-{os.getpid()}-{int(time.time() * 1000)}")
+    if _profiler == 'cprofile':
+        profiler.disable()
+        profiler.dump_stats(f"{base_path}.prof")
+        return f"{base_path}.prof"
+    profiler.stop()
+    with open(f"{base_path}.html", 'w') as f:
+        f.write(profiler.output_html())
+    return f"{base_path}.html"
+
+
+def record_input_rows(*values):
+    """
+    Add the rows of DataFrames loaded inside an instrumented call to its 'rows_in', e.g. stage inputs
+    that parquet_stage reads from the work directory rather than receiving them as arguments.
+    """
+    records = getattr(_local, 'records', None)
+    if _log_path is None or not records:
+        return
+    rows = sum(count for count in map(_count_rows, values) if count)
+    if rows:
+        records[-1]['rows_in'] = (records[-1]['rows_in'] or 0) + rows
+
+
+def _write_record(record):
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock, open(_log_path, 'a') as f:
+        f.write(line)
+
+
+def instrumented(function):
+    """
+    Records wall time, CPU time, peak RSS, input/output rows and model items/sec of every call while
+    instrumentation is enabled. When it is disabled the wrapper only checks one module variable.
+
+    'cpu_seconds' is the CPU time of the calling thread and 'process_cpu_seconds' that of the whole process,
+    including worker threads and concurrent calls. Peak RSS is per process: an outermost call resets it only
+    when no other outermost call is running in another thread, and reports 'peak_rss_scope': 'call' only if
+    none started before it ended. Otherwise, and for nested calls, the scope is 'process'.
+    """
+    name = function.__name__
+    parameters = list(inspect.signature(function).parameters)
+    city_parameter = next((parameter for parameter in ('city_name', 'city') if parameter in parameters), None)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _log_path is None:
+            return function(*args, **kwargs)
+
+        global _active_calls, _started_calls
+        depth = getattr(_local, 'depth', 0)
+        outermost = depth == 0
+        profiler = _start_profiler(name) if outermost else None
+        model_items = _model_items()
+
+        record = {
+            'function': name,
+            'module': function.__module__,
+            'pid': os.getpid(),
+            'depth': depth,
+            'city': _city(city_parameter, parameters, args, kwargs),
+            'rows_in': sum(count for count in map(_count_rows, list(args) + list(kwargs.values())) if count) or None,
+            'start': time.time(),
+        }
+        rss_reset = False
+        if outermost:
+            # The reset is process-wide, so it would clear the peak of calls running in other threads
+            with _active_lock:
+                rss_reset = _active_calls == 0 and _reset_peak_rss()
+                _active_calls += 1
+                _started_calls += 1
+                started_calls = _started_calls
+        _local.depth = depth + 1
+        _local.records = getattr(_local, 'records', []) + [record]
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        process_cpu_start = time.process_time()
+        try:
+            result = function(*args, **kwargs)
+            record['status'] = 'ok'
+            record['rows_out'] = _count_rows(result)
+            return result
+        except BaseException as e:
+            record['status'] = 'error'
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _local.depth = depth
+            _local.records = _local.records[:-1]
+            record['wall_seconds'] = time.perf_counter() - wall_start
+            record['cpu_seconds'] = time.thread_time() - cpu_start
+            record['process_cpu_seconds'] = time.process_time() - process_cpu_start
+            record['peak_rss_mb'] = _peak_rss_mb()
+            if outermost:
+                with _active_lock:
+                    _active_calls -= 1
+                    rss_reset = rss_reset and _started_calls == started_calls
+            record['peak_rss_scope'] = 'call' if rss_reset else 'process'
+            record['model_items'] = _model_items() - model_items
+            record['items_per_second'] = record['model_items'] / record['wall_seconds'] if record['model_items'] and record['wall_seconds'] else None
+            if profiler is not None:
+                record['profile'] = _save_profile(profiler, name)
+            _write_record(record)
+
+    return wrapper
+
+
+def read_instrumentation_log(log_path):
+    """Load a JSON-lines instrumentation log as a DataFrame, one row per call."""
+    return pd.read_json(log_path, lines=True)
@@ -1,6 +1,12 @@
-import gdown
+import hashlib
+import json
+import os
+import shutil
+import urllib.error
+import urllib.request
 import zipfile
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from .Instrumentation import instrumented
 
 
 # Define a dictionary with city names and their corresponding Google Drive file IDs
@@ -14,34 +20,276 @@ city_file_ids = {
     'rome': '1FYLxvyuQGvVyf2VijEfeRxFw3G16RAXT',
 }
 
-# Function to download and extract data for the specified city
-def download_and_extract_city_data(city_name):
-    # Get the file ID for the selected city
-    file_id = city_file_ids.get(city_name)
+# Bytes copied per read while streaming archives and members to disk
+copy_chunk_size = 1024 * 1024
+
+
+def required_members(city_name):
+    """Names of the CSV files of a city that the pipeline reads."""
+    members = []
+    for i in range(1, 5):
+        members += [
+            f"calendar_{city_name}{i}.csv",
+            f"{city_name}_listings{i}.csv",
+            f"{city_name}_listings{i}_long.csv",
+            f"{city_name}_reviews{i}.csv",
+        ]
+    return members
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(copy_chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GoogleDriveSource:
+    """
+    Downloads the city archives from Google Drive with gdown, which resumes partial downloads.
+
+    Google Drive publishes no checksums, so unless `checksums` are given, fetch_city checks later downloads
+    against the sha256 recorded in the manifest of the first complete download.
+
+    Args:
+    - file_ids: Dict mapping city names to Google Drive file ids.
+    - checksums: Optional dict mapping city names to the expected sha256 of their archive.
+    """
+
+    def __init__(self, file_ids=city_file_ids, checksums=None):
+        self.file_ids = file_ids
+        self.checksums = checksums or {}
+
+    def fetch(self, city_name, path):
+        try:
+            import gdown
+        except ImportError as e:
+            raise ImportError("Downloading from Google Drive requires gdown: pip install gdown") from e
+
+        # Get the file ID for the selected city
+        file_id = self.file_ids.get(city_name)
+
+        # If file_id is None, the city is not available
+        if not file_id:
+            raise ValueError(f"No file ID found for city: {city_name}")
+
+        gdown.download(id=file_id, output=path, quiet=False, resume=True)
+
+    def expected_checksum(self, city_name):
+        return self.checksums.get(city_name)
+
+
+class MirrorSource:
+    """
+    Copies '{city}.zip' archives from a mirror: a local directory, a file:// URL or an http(s):// URL.
+
+    Partial copies are kept in '{path}.part' and continued from their current size, with a Range request
+    for http(s) mirrors. An optional '{city}.zip.sha256' file next to an archive holds its expected sha256.
+    """
+
+    def __init__(self, location):
+        if location.startswith('file://'):
+            location = urllib.request.url2pathname(location[len('file://'):])
+        self.location = location.rstrip('/')
+        self.is_url = location.startswith(('http://', 'https://'))
+
+    def _open(self, name, offset=0):
+        if self.is_url:
+            request = urllib.request.Request(f"{self.location}/{name}")
+            if offset:
+                request.add_header('Range', f"bytes={offset}-")
+            response = urllib.request.urlopen(request)
+            if offset and response.status != 206:
+                # The server ignored the range, so start over
+                response.close()
+                raise ValueError("Range requests are not supported")
+            return response
+        f = open(os.path.join(self.location, name), 'rb')
+        f.seek(offset)
+        return f
+
+    def fetch(self, city_name, path):
+        part_path = f"{path}.part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            source = self._open(f"{city_name}.zip", offset)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # Nothing left to download
+            os.replace(part_path, path)
+            return
+        except ValueError:
+            offset = 0
+            source = self._open(f"{city_name}.zip")
+        if offset:
+            print(f"Resuming {city_name}.zip at {offset / 1024 ** 2:.1f} MB")
+
+        with source, open(part_path, 'ab' if offset else 'wb') as f:
+            shutil.copyfileobj(source, f, copy_chunk_size)
+        os.replace(part_path, path)
+
+    def expected_checksum(self, city_name):
+        try:
+            with self._open(f"{city_name}.zip.sha256") as f:
+                return f.read().decode().split()[0]
+        except (OSError, IndexError):
+            return None
 
-    # If file_id is None, the city is not available
-    if not file_id:
-        raise ValueError(f"No file ID found for city: {city_name}")
 
-    # Destination path for extraction
-    destination_path = '/content'  # Extract directly to /content
+def make_source(location=None):
+    """Source for a location: None or 'gdrive' for Google Drive, otherwise a mirror directory or URL."""
+    if location in (None, 'gdrive'):
+        return GoogleDriveSource()
+    return MirrorSource(location)
 
-    # Direct download link using gdown
-    download_url = f'https://drive.google.com/uc?export=download&id={file_id}'
 
-    # Download the zip file content directly into memory
-    zip_file_content = BytesIO()
-    gdown.download(download_url, zip_file_content, quiet=False)
+def manifest_path(city_name, destination_path):
+    return os.path.join(destination_path, f".{city_name}_manifest.json")
 
-    # Move the cursor to the beginning of the BytesIO object
-    zip_file_content.seek(0)
 
-    # Check the contents of the zip file
-    with zipfile.ZipFile(zip_file_content, 'r') as zip_ref:
-        zip_file_list = zip_ref.namelist()
-        print(f"Files in the zip for {city_name}: {zip_file_list}")
+def recorded_checksum(city_name, destination_path):
+    """The archive sha256 recorded in the manifest of a previous complete download, or None."""
+    try:
+        with open(manifest_path(city_name, destination_path)) as f:
+            return json.load(f).get('sha256')
+    except (OSError, ValueError):
+        return None
 
-        # Extract all files to the specified directory
-        zip_ref.extractall(destination_path)
 
-    print(f"Files for {city_name} have been extracted to: {destination_path}")
\ No newline at end of file
+def city_is_present(city_name, destination_path, expected_checksum=None):
+    """
+    Whether the CSV files of a city were fully extracted from a verified archive.
+
+    The manifest written by fetch_city records the archive checksum and the size of every extracted file.
+    """
+    try:
+        with open(manifest_path(city_name, destination_path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if expected_checksum and manifest.get('sha256') != expected_checksum:
+        return False
+    return all(
+        os.path.exists(os.path.join(destination_path, name)) and os.path.getsize(os.path.join(destination_path, name)) == size
+        for name, size in manifest.get('members', {}).items()
+    )
+
+
+def extract_members(archive_path, destination_path, names):
+    """
+    Streams the zip members whose file name is in `names` to `destination_path`, ignoring folders inside the zip.
+
+    Returns:
+    - sizes: Dict mapping every extracted file name to its size.
+    """
+    sizes = {}
+    with zipfile.ZipFile(archive_path) as zip_ref:
+        for info in zip_ref.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or name not in names:
+                continue
+            target = os.path.join(destination_path, name)
+            with zip_ref.open(info) as source, open(f"{target}.tmp", 'wb') as f:
+                shutil.copyfileobj(source, f, copy_chunk_size)
+            os.replace(f"{target}.tmp", target)
+            sizes[name] = info.file_size
+    return sizes
+
+
+@instrumented
+def fetch_city(city_name, destination_path='/content', source=None, keep_archive=False):
+    """
+    Downloads and extracts the CSV files of a city, skipping the city when it is already present and valid.
+
+    The archive is streamed to '{destination_path}/{city}.zip' (resuming an interrupted download), its
+    sha256 is checked against the checksum published by the source, else against the one recorded by
+    the first complete download, and only the CSV files used by the pipeline are extracted. The manifest
+    marking the city as present is only written once every required file was extracted.
+
+    Args:
+    - city_name: Name of the city.
+    - destination_path: Directory for the extracted CSV files.
+    - source: A GoogleDriveSource or MirrorSource, or a location passed to make_source. Defaults to Google Drive.
+    - keep_archive: Keep the zip file after extraction.
+
+    Returns:
+    - destination_path: The directory holding the CSV files.
+    """
+    source = source if hasattr(source, 'fetch') else make_source(source)
+    os.makedirs(destination_path, exist_ok=True)
+    expected_checksum = source.expected_checksum(city_name)
+    first_seen_checksum = recorded_checksum(city_name, destination_path)
+
+    if city_is_present(city_name, destination_path, expected_checksum):
+        print(f"Files for {city_name} are already present in: {destination_path}")
+        return destination_path
+
+    archive_path = os.path.join(destination_path, f"{city_name}.zip")
+    if not os.path.exists(archive_path):
+        source.fetch(city_name, archive_path)
+
+    checksum = file_sha256(archive_path)
+    if expected_checksum and checksum != expected_checksum:
+        os.remove(archive_path)
+        raise ValueError(f"Checksum mismatch for {city_name}.zip: expected {expected_checksum}, got {checksum}")
+    if not expected_checksum and first_seen_checksum and checksum != first_seen_checksum:
+        os.remove(archive_path)
+        raise ValueError(f"Checksum mismatch for {city_name}.zip: expected {first_seen_checksum} from the first download, "
+                         f"got {checksum}. Delete {manifest_path(city_name, destination_path)} to accept the new archive")
+
+    try:
+        sizes = extract_members(archive_path, destination_path, set(required_members(city_name)))
+    except zipfile.BadZipFile:
+        # A truncated or corrupt archive is downloaded again on the next run
+        os.remove(archive_path)
+        raise
+    print(f"Extracted {len(sizes)} files for {city_name} to: {destination_path}")
+
+    # Without a manifest the city is downloaded again on the next run
+    missing = [name for name in required_members(city_name) if name not in sizes]
+    if missing:
+        os.remove(archive_path)
+        raise FileNotFoundError(f"Files missing from the {city_name} archive: {missing}")
+
+    with open(manifest_path(city_name, destination_path), 'w') as f:
+        json.dump({'sha256': checksum, 'members': sizes}, f)
+    if not keep_archive:
+        os.remove(archive_path)
+
+    return destination_path
+
+
+@instrumented
+def fetch_cities(cities, destination_path='/content', source=None, max_workers=4, keep_archive=False):
+    """
+    Fetches several cities concurrently with fetch_city.
+
+    Args:
+    - cities: List of city names.
+    - destination_path: Directory for the extracted CSV files, or a dict mapping city names to directories.
+    - source: Passed to fetch_city.
+    - max_workers: Number of cities downloaded at the same time.
+    - keep_archive: Keep the zip files after extraction.
+
+    Returns:
+    - destinations: Dict mapping every city to the directory holding its CSV files.
+    """
+    source = source if hasattr(source, 'fetch') else make_source(source)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            city_name: executor.submit(
+                fetch_city, city_name,
+                destination_path[city_name] if isinstance(destination_path, dict) else destination_path,
+                source, keep_archive,
+            )
+            for city_name in cities
+        }
+        return {city_name: future.result() for city_name, future in futures.items()}
+
+
+# Function to download and extract data for the specified city
+@instrumented
+def download_and_extract_city_data(city_name, destination_path='/content', source=None):
+    return fetch_city(city_name, destination_path, source)
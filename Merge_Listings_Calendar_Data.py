@@ -1,47 +1,110 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from .Instrumentation import instrumented
+from .Stage_Store import parquet_stage
 
 
-def prepare_combined_data(combined_calender, combined_listings_extended):
-    # Rename columns
-    combined_calender = combined_calender.rename(columns={'listing_id': 'id'})
-    combined_listings_extended = combined_listings_extended.rename(columns={'price': 'prices', 'ratings': 'review_scores_rating'})
+# Calendar months kept in the combined data
+window_start = '2023-09-01'
+window_end = '2024-06-30'
+
+
+def parse_prices(prices):
+    """
+    Parses price strings such as '$1,234.00' to float64 in one Arrow regex pass over the distinct values.
+
+    Numeric input is returned as float64 unchanged; missing values stay NaN.
+    """
+    if pd.api.types.is_numeric_dtype(prices):
+        return prices.astype('float64')
+
+    codes, uniques = pd.factorize(prices)
+    cleaned = pc.replace_substring_regex(pa.array(np.asarray(uniques).astype(str), type=pa.string()), pattern=r'[$,]', replacement='')
+    parsed = np.append(cleaned.cast(pa.float64()).to_numpy(zero_copy_only=False), np.nan)
+    return pd.Series(parsed[codes], index=prices.index, name=prices.name)
+
+
+def sorted_key_join(calendar, listings):
+    """
+    Inner join of the calendar with the listings on the int64 'id' key, keeping the calendar row order.
+
+    The listings are sorted once and every calendar key is located with a binary search, so neither side
+    is hashed or copied beyond the matching rows. Listings with repeated ids fall back to a hash merge.
+    """
+    listings = listings.sort_values('id', kind='stable', ignore_index=True)
+    listing_ids = listings['id'].to_numpy()
+    if len(listing_ids) > 1 and (listing_ids[1:] == listing_ids[:-1]).any():
+        return pd.merge(calendar, listings, on='id', how='inner', suffixes=('', '_listings'))
 
-    # Ensure 'id' is an integer
-    combined_calender['id'] = combined_calender['id'].astype(int)
-    combined_listings_extended['id'] = combined_listings_extended['id'].astype(int)
+    calendar_ids = calendar['id'].to_numpy()
+    positions = np.searchsorted(listing_ids, calendar_ids).clip(max=max(len(listing_ids) - 1, 0))
+    matched = listing_ids[positions] == calendar_ids if len(listing_ids) else np.zeros(len(calendar_ids), dtype=bool)
 
-    # Perform the merge
-    combined_data = pd.merge(combined_calender, combined_listings_extended, on='id', how='left', suffixes=('', '_listings'))
+    left = calendar[matched].reset_index(drop=True)
+    right = listings.drop(columns=['id']).take(positions[matched]).reset_index(drop=True)
+    right.columns = [f"{column}_listings" if column in left.columns else column for column in right.columns]
+    return pd.concat([left, right], axis=1)
 
-    # Drop rows where 'prices' column is empty (NaN or empty string)
-    combined_data = combined_data.dropna(subset=['prices'])
 
-    # Drop unnecessary columns
-    combined_data = combined_data.drop(columns=['prices'])
+def reviews_per_month_fill_value(combined_calender, combined_listings_extended):
+    """
+    Mean 'reviews_per_month' over all joined calendar rows, as if taken after a join of every month:
+    each listing with a price weighs as much as its number of calendar rows.
 
-    # Ensure 'price' column is treated as string
-    combined_data['price'] = combined_data['price'].astype(str)
+    Computed on a whole city, it lets prepare_combined_data fill a subset of listings like a full build.
+    """
+    calendar_ids = combined_calender['listing_id' if 'listing_id' in combined_calender else 'id'].astype('int64')
+    listings = combined_listings_extended.dropna(subset=['price'])
+    calendar_rows = listings['id'].astype('int64').map(calendar_ids.value_counts()).fillna(0)
+    reviews_per_month = pd.to_numeric(listings['reviews_per_month'], errors='coerce')
+    return (reviews_per_month * calendar_rows).sum() / calendar_rows[reviews_per_month.notna()].sum()
 
-    # Remove dollar signs and commas using str.replace
-    combined_data['price'] = combined_data['price'].str.replace('$', '', regex=False)  # First remove dollar signs
-    combined_data['price'] = combined_data['price'].str.replace(',', '', regex=False)  # Then remove commas
 
-    # Convert to float
-    combined_data['price'] = combined_data['price'].astype(float)
+@instrumented
+@parquet_stage('combined', inputs={'combined_calender': 'calendar', 'combined_listings_extended': 'listings'})
+def prepare_combined_data(combined_calender, combined_listings_extended, reviews_per_month_mean=None):
+    """
+    Joins the calendar months with their listings in the date window and parses the prices.
+
+    Args:
+    - combined_calender: Output of process_city_calender.
+    - combined_listings_extended: Output of process_city_listings.
+    - reviews_per_month_mean: Value filling missing 'reviews_per_month'. By default the mean of these inputs
+      (see reviews_per_month_fill_value); pass the city-wide value when the inputs hold a subset of listings.
+
+    Returns:
+    - combined_data: One row per available listing month.
+    """
+    if reviews_per_month_mean is None:
+        reviews_per_month_mean = reviews_per_month_fill_value(combined_calender, combined_listings_extended)
+
+    # Rename columns
+    combined_calender = combined_calender.rename(columns={'listing_id': 'id'})
+    combined_listings_extended = combined_listings_extended.rename(columns={'price': 'prices', 'ratings': 'review_scores_rating'})
+
+    # Ensure 'id' is an int64 key on both sides
+    combined_calender['id'] = combined_calender['id'].astype('int64')
+    combined_listings_extended['id'] = combined_listings_extended['id'].astype('int64')
 
     # Convert 'reviews_per_month' to numeric, coercing errors to NaN
-    combined_data['reviews_per_month'] = pd.to_numeric(combined_data['reviews_per_month'], errors='coerce')
+    combined_listings_extended['reviews_per_month'] = pd.to_numeric(combined_listings_extended['reviews_per_month'], errors='coerce')
 
-    # Fill NaN values in 'reviews_per_month' with the mean
-    combined_data['reviews_per_month'] = combined_data['reviews_per_month'].fillna(combined_data['reviews_per_month'].mean())
+    # Drop listings without 'prices' before the join, then the column itself, so it is never joined
+    combined_listings_extended = combined_listings_extended.dropna(subset=['prices']).drop(columns=['prices'])
 
-    # Convert 'date' column to datetime
-    combined_data['date'] = pd.to_datetime(combined_data['date'], errors='coerce')
+    # Filter the calendar on the date window before the join; unparseable dates drop out here as well
+    dates = pd.to_datetime(combined_calender['date'], errors='coerce')
+    combined_calender = combined_calender[(dates >= window_start) & (dates < window_end)].assign(date=dates)
 
-    # Drop rows where 'date' could not be parsed
-    combined_data = combined_data.dropna(subset=['date'])
+    # Join the remaining calendar rows with their listing on the sorted int64 keys
+    combined_data = sorted_key_join(combined_calender, combined_listings_extended)
 
-    # Filter based on the date condition
-    combined_data = combined_data[(combined_data['date'] >= '2023-09-01') & (combined_data['date'] < '2024-06-30')]
+    # Parse 'price' strings such as '$1,234.00' to float
+    combined_data['price'] = parse_prices(combined_data['price'])
+
+    # Fill NaN values in 'reviews_per_month' with the mean
+    combined_data['reviews_per_month'] = combined_data['reviews_per_month'].fillna(reviews_per_month_mean)
 
-    return combined_data
\ No newline at end of file
+    return combined_data
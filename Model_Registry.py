@@ -0,0 +1,253 @@
+import gc
+import os
+import shutil
+import threading
+import time
+import torch
+from transformers import AutoTokenizer, pipeline
+from .Instrumentation import instrumented
+
+
+# Models used by the NLP stages
+sentiment_model_name = "nlptown/bert-base-multilingual-uncased-sentiment"
+zero_shot_model_name = "joeddav/xlm-roberta-large-xnli"
+
+default_models = [
+    ("sentiment-analysis", sentiment_model_name),
+    ("zero-shot-classification", zero_shot_model_name),
+]
+
+# Inference backends: eager fp32 PyTorch, dynamically int8-quantized PyTorch and exported ONNX Runtime graphs
+backends = ("torch", "torch-int8", "onnx")
+
+# Directory of the exported ONNX graphs, one folder per model, so each model is only exported once
+onnx_cache_env = 'AIRBNB_BACKEND_ONNX_CACHE'
+default_onnx_cache = os.path.join(os.path.expanduser('~'), '.cache', 'airbnb_backend', 'onnx')
+
+# Pipeline arguments applied to every load of a task
+pipeline_defaults = {
+    "sentiment-analysis": {"truncation": True},
+}
+
+_pipelines = {}
+_lock = threading.Lock()
+
+
+class TimedPipeline:
+    """
+    Wraps a transformers pipeline and records its load time and call latencies.
+
+    Attribute access (model, tokenizer, ...) is forwarded to the wrapped pipeline.
+    """
+
+    def __init__(self, task, model_name, pipe, load_seconds, backend="torch"):
+        self.task = task
+        self.model_name = model_name
+        self.backend = backend
+        self.pipeline = pipe
+        self.load_seconds = load_seconds
+        self.first_call_seconds = None
+        self.warm_calls = 0
+        self.warm_call_seconds = 0.0
+        self.items = 0
+
+    def __call__(self, inputs, *args, **kwargs):
+        start = time.perf_counter()
+        outputs = self.pipeline(inputs, *args, **kwargs)
+        self.record(len(inputs) if isinstance(inputs, list) else 1, time.perf_counter() - start)
+        return outputs
+
+    def record(self, items, elapsed):
+        """Count a call, also for callers that run the model and tokenizer directly instead of the pipeline."""
+        self.items += items
+        if self.first_call_seconds is None:
+            self.first_call_seconds = elapsed
+        else:
+            self.warm_calls += 1
+            self.warm_call_seconds += elapsed
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def stats(self):
+        return {
+            'task': self.task,
+            'model': self.model_name,
+            'backend': self.backend,
+            'load_seconds': self.load_seconds,
+            'first_call_seconds': self.first_call_seconds,
+            'warm_calls': self.warm_calls,
+            'warm_call_mean_seconds': self.warm_call_seconds / self.warm_calls if self.warm_calls else None,
+            'items': self.items,
+        }
+
+
+def model_key(model_name, backend="torch"):
+    """Name identifying a model and backend, e.g. for inference cache keys. Outputs of other backends may drift from fp32."""
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+
+def onnx_export_path(model_name):
+    """Folder of the cached ONNX export of a model, under $AIRBNB_BACKEND_ONNX_CACHE or ~/.cache/airbnb_backend/onnx."""
+    cache_dir = os.environ.get(onnx_cache_env) or default_onnx_cache
+    return os.path.join(cache_dir, model_name.strip('/').replace('/', '--'))
+
+
+def _load_onnx_model(model_name):
+    """Loads the cached ONNX export of a model, exporting it and saving it with its tokenizer on first use."""
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    path = onnx_export_path(model_name)
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return ORTModelForSequenceClassification.from_pretrained(path), AutoTokenizer.from_pretrained(path)
+
+    model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    # Save next to the final folder and rename, so an interrupted export is never loaded
+    temporary_path = f"{path}.tmp-{os.getpid()}"
+    model.save_pretrained(temporary_path)
+    tokenizer.save_pretrained(temporary_path)
+    try:
+        os.replace(temporary_path, path)
+        print(f"Exported {model_name} to ONNX in {path}")
+    except OSError:
+        # Another process saved the same export first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return model, tokenizer
+
+
+def _load_pipeline(task, model_name, backend, kwargs):
+    if backend == "torch":
+        device = 0 if torch.cuda.is_available() else -1
+        return pipeline(task, model=model_name, tokenizer=model_name, device=device, framework='pt', **kwargs)
+
+    if backend == "torch-int8":
+        # Dynamic quantization replaces the Linear layers with int8 kernels, which only run on CPU
+        pipe = pipeline(task, model=model_name, tokenizer=model_name, device=-1, framework='pt', **kwargs)
+        pipe.model = torch.ao.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return pipe
+
+    if backend == "onnx":
+        try:
+            import optimum.onnxruntime  # noqa: F401
+        except ImportError as e:
+            raise ImportError("The 'onnx' backend requires optimum with onnxruntime: pip install optimum[onnxruntime]") from e
+        model, tokenizer = _load_onnx_model(model_name)
+        return pipeline(task, model=model, tokenizer=tokenizer, **kwargs)
+
+    raise ValueError(f"Unknown backend: {backend}. Choose one of {backends}")
+
+
+def get_pipeline(task, model_name, backend="torch", **kwargs):
+    """
+    Return the process-wide pipeline for (task, model_name, backend), loading it on first use.
+
+    Args:
+    - task: The transformers pipeline task, e.g. "sentiment-analysis".
+    - model_name: The model (and tokenizer) to load.
+    - backend: One of `backends`: "torch" (fp32), "torch-int8" (dynamic int8 quantization on CPU) or
+      "onnx" (ONNX Runtime through optimum, exported once per model and cached, see onnx_export_path).
+    - kwargs: Extra arguments passed to `transformers.pipeline` on the first load only, on top of
+      `pipeline_defaults`.
+
+    Returns:
+    - pipe: A TimedPipeline that can be called like the underlying pipeline.
+    """
+    key = (task, model_name, backend)
+    with _lock:
+        if key not in _pipelines:
+            start = time.perf_counter()
+            kwargs = {**pipeline_defaults.get(task, {}), **kwargs}
+            pipe = _load_pipeline(task, model_name, backend, kwargs)
+            _pipelines[key] = TimedPipeline(task, model_name, pipe, time.perf_counter() - start, backend)
+            print(f"Loaded {model_name} ({backend}) for {task} in {_pipelines[key].load_seconds:.1f} s")
+        return _pipelines[key]
+
+
+@instrumented
+def prewarm(models=None, backend="torch"):
+    """Load the given (task, model_name) pairs ahead of time, by default every model used by the NLP stages."""
+    for task, model_name in models or default_models:
+        get_pipeline(task, model_name, backend)
+
+
+@instrumented
+def unload(task=None, model_name=None, backend=None):
+    """
+    Drop loaded pipelines to free memory. Without arguments every pipeline is unloaded.
+
+    Returns:
+    - unloaded: List of the (task, model_name, backend) keys that were unloaded.
+    """
+    with _lock:
+        unloaded = [
+            key for key in _pipelines
+            if (task is None or key[0] == task) and (model_name is None or key[1] == model_name)
+            and (backend is None or key[2] == backend)
+        ]
+        for key in unloaded:
+            del _pipelines[key]
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return unloaded
+
+
+@instrumented
+def set_num_threads(num_threads):
+    """Set the number of CPU threads used by PyTorch for intra-op parallelism."""
+    torch.set_num_threads(num_threads)
+
+
+def model_stats():
+    """Return the load time, first-call and warm-call latency of every loaded pipeline."""
+    with _lock:
+        return [pipe.stats() for pipe in _pipelines.values()]
+
+
+@instrumented
+def check_backend_agreement(texts, task, model_name, backend, candidate_labels=None, max_drift=None, batch_size=32):
+    """
+    Compares the labels of a backend with the fp32 "torch" labels on a sample of texts.
+
+    Args:
+    - texts: Sample of texts, e.g. a few hundred descriptions or reviews.
+    - task: "sentiment-analysis" or "zero-shot-classification".
+    - model_name: The model to compare.
+    - backend: The backend to check against fp32.
+    - candidate_labels: Labels for zero-shot classification.
+    - max_drift: If given, raise a ValueError when the fraction of changed labels exceeds it.
+
+    Returns:
+    - report: Dict with the label agreement, label drift, timings and speedup over fp32.
+    """
+    def top_labels(pipe):
+        start = time.perf_counter()
+        if task == "zero-shot-classification":
+            results = pipe(list(texts), candidate_labels=candidate_labels, batch_size=batch_size)
+            labels = [result['labels'][0] for result in results]
+        else:
+            labels = [result['label'] for result in pipe(list(texts), batch_size=batch_size)]
+        return labels, time.perf_counter() - start
+
+    reference_labels, reference_seconds = top_labels(get_pipeline(task, model_name, "torch"))
+    backend_labels, backend_seconds = top_labels(get_pipeline(task, model_name, backend))
+
+    agreement = sum(a == b for a, b in zip(reference_labels, backend_labels)) / max(len(texts), 1)
+    report = {
+        'task': task,
+        'model': model_name,
+        'backend': backend,
+        'texts': len(texts),
+        'agreement': agreement,
+        'label_drift': 1 - agreement,
+        'fp32_seconds': reference_seconds,
+        'backend_seconds': backend_seconds,
+        'speedup': reference_seconds / backend_seconds if backend_seconds else None,
+    }
+    speedup = f"{report['speedup']:.2f}x" if report['speedup'] is not None else "unmeasured"
+    print(f"{model_name} {backend}: {agreement:.1%} label agreement with fp32, {speedup} speedup")
+
+    if max_drift is not None and report['label_drift'] > max_drift:
+        raise ValueError(f"Label drift of {backend} is {report['label_drift']:.1%}, above the allowed {max_drift:.1%}")
+    return report
@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from .Arima import arima_forecast_and_save
+from .Load_Data import fetch_city
+from .Merge_Listings_Calendar_Data import prepare_combined_data
+from .Process_Calendar_Data import process_city_calender
+from .Process_Listing_Data import process_city_listings
+from .Processing_Amenities import process_combined_data
+from .Sentiment_Analysis_Description import analyze_sentiment
+from .Sentiment_Analysis_Reviews import process_city_reviews
+from .Zero_Shot_Classification import classify_property_descriptions
+
+
+# Stages of one city: (name, kind, dependencies). 'cpu' stages run in worker processes, 'model' stages
+# run one at a time in the main process so that a single loaded model serves every city, and 'io'
+# stages run in a thread.
+city_stages = [
+    ('download', 'io', []),
+    ('calendar', 'cpu', ['download']),
+    ('listings', 'cpu', ['download']),
+    ('combined', 'cpu', ['calendar', 'listings']),
+    ('categories', 'model', ['combined']),
+    ('amenities', 'cpu', ['categories']),
+    ('description_sentiment', 'model', ['amenities']),
+    ('review_sentiment', 'model', ['description_sentiment']),
+    ('final', 'cpu', ['review_sentiment']),
+]
+
+
+def city_dataset_dir(workdir, city_name, dataset_dir=None):
+    """Directory holding the raw CSV files of a city."""
+    return dataset_dir or os.path.join(workdir, city_name, 'raw')
+
+
+def run_stage(city_name, stage, workdir, options, input_stage=None):
+    """
+    Runs one stage of one city, reading its inputs from and writing its output to the city work directory.
+
+    `input_stage` is the dependency the stage reads its DataFrame from, so that files left by stages
+    skipped in this run (e.g. 'review_sentiment' without --reviews) are never read.
+
+    Module-level so that it can be sent to worker processes.
+
+    Returns:
+    - elapsed: Wall time of the stage in seconds.
+    """
+    start = time.perf_counter()
+    city_dir = os.path.join(workdir, city_name)
+    dataset_dir = city_dataset_dir(workdir, city_name, options.get('dataset_dir'))
+    resume = options.get('resume', False)
+    cache = options.get('cache')
+    backend = options.get('backend', 'torch')
+
+    if stage == 'download':
+        fetch_city(city_name, dataset_dir, source=options.get('source'))
+    elif stage == 'calendar':
+        process_city_calender(city_name, dataset_dir, chunksize=options.get('chunksize'), workdir=city_dir, resume=resume)
+    elif stage == 'listings':
+        process_city_listings(city_name, dataset_dir, workdir=city_dir, resume=resume)
+    elif stage == 'combined':
+        prepare_combined_data(workdir=city_dir, resume=resume)
+    elif stage == 'categories':
+        classify_property_descriptions(None, cache=cache, backend=backend, dedup_threshold=options.get('dedup_threshold'),
+                                       workdir=city_dir, resume=resume, input_stage=input_stage)
+    elif stage == 'amenities':
+        process_combined_data(None, index_dir=os.path.join(city_dir, 'amenity_index'), workdir=city_dir, resume=resume, input_stage=input_stage)
+    elif stage == 'description_sentiment':
+        analyze_sentiment(None, cache=cache, backend=backend, dedup_threshold=options.get('dedup_threshold'),
+                          workdir=city_dir, resume=resume, input_stage=input_stage)
+    elif stage == 'review_sentiment':
+        process_city_reviews(None, city_name, dataset_dir=dataset_dir, cache=cache, backend=backend, chunksize=options.get('chunksize'),
+                             workdir=city_dir, resume=resume, input_stage=input_stage)
+    elif stage == 'final':
+        arima_forecast_and_save(city_name, None, output_dir=city_dir, method=options.get('forecast_method', 'arima'),
+                                estimator=options.get('forecast_estimator', 'ses'), state_path=os.path.join(city_dir, 'arima_state.json'), workdir=city_dir, resume=resume,
+                                input_stage=input_stage)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return time.perf_counter() - start
+
+
+def build_city_dag(city_name, reviews=True, download=True):
+    """
+    Returns the stage graph of one city as a dict mapping (city, stage) to (kind, dependencies).
+    """
+    skipped = set()
+    if not reviews:
+        skipped.add('review_sentiment')
+    if not download:
+        skipped.add('download')
+
+    dag = {}
+    for stage, kind, dependencies in city_stages:
+        if stage in skipped:
+            continue
+        # Depend on the nearest stages that are not skipped
+        resolved = []
+        pending = list(dependencies)
+        while pending:
+            dependency = pending.pop()
+            if dependency in skipped:
+                pending.extend(next(deps for name, _, deps in city_stages if name == dependency))
+            else:
+                resolved.append((city_name, dependency))
+        dag[(city_name, stage)] = (kind, resolved)
+    return dag
+
+
+def run_cities(cities, workdir, jobs=1, reviews=False, dataset_dir=None, resume=False, cache=None, chunksize=None, backend='torch',
+               forecast_method='arima', source=None, dedup_threshold=None, forecast_estimator='ses'):
+    """
+    Processes several cities, running independent CPU-bound stages of different cities concurrently.
+
+    Args:
+    - cities: List of city names.
+    - workdir: Work directory; each city uses '{workdir}/{city}' for its stage files and final data.
+    - jobs: Number of worker processes for CPU-bound stages.
+    - reviews: Whether to run the review sentiment stage.
+    - dataset_dir: Directory with already extracted CSV files. If None, every city is downloaded to
+      '{workdir}/{city}/raw'.
+    - resume: Reuse stage outputs that already exist in the work directory.
+    - cache: Optional path to an inference cache shared by the model-bound stages.
+    - chunksize: If set, calendar and review files are streamed in chunks of this many rows.
+    - backend: Inference backend of the model-bound stages, "torch", "torch-int8" or "onnx".
+    - forecast_method: Price forecasting method of the final stage, 'arima' or 'hierarchical'.
+    - source: Where cities are downloaded from: None for Google Drive, or a mirror directory or URL
+      holding '{city}.zip' files (see Load_Data.make_source). Cities already present are not downloaded again.
+    - dedup_threshold: If set, the description stages run their model once per cluster of near-duplicate
+      descriptions at this similarity (see Description_Dedup).
+    - forecast_estimator: Base estimator of the 'hierarchical' forecasting method, 'ses' or 'ar1'.
+
+    Returns:
+    - timings: Dict mapping (city, stage) to wall time in seconds.
+    - failures: Dict mapping city to the error message of the stage that failed.
+    """
+    options = {'dataset_dir': dataset_dir, 'resume': resume, 'cache': cache, 'chunksize': chunksize, 'backend': backend,
+               'forecast_method': forecast_method, 'source': source, 'dedup_threshold': dedup_threshold,
+               'forecast_estimator': forecast_estimator}
+
+    dag = {}
+    for city_name in cities:
+        dag.update(build_city_dag(city_name, reviews=reviews, download=dataset_dir is None))
+
+    timings = {}
+    failures = {}
+    running = {}
+    pending = dict(dag)
+
+    cpu_executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+    model_executor = ThreadPoolExecutor(max_workers=1)
+    io_executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    executors = {'cpu': cpu_executor, 'model': model_executor, 'io': io_executor}
+
+    try:
+        while pending or running:
+            # Submit every stage whose dependencies are done
+            for key, (kind, dependencies) in list(pending.items()):
+                city_name, stage = key
+                if city_name in failures:
+                    del pending[key]
+                elif all(dependency in timings for dependency in dependencies):
+                    del pending[key]
+                    # A single dependency is the stage whose output this stage reads
+                    input_stage = dependencies[0][1] if len(dependencies) == 1 else None
+                    running[executors[kind].submit(run_stage, city_name, stage, workdir, options, input_stage)] = key
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                city_name, stage = running.pop(future)
+                try:
+                    timings[(city_name, stage)] = future.result()
+                    print(f"[{city_name}] {stage} finished in {timings[(city_name, stage)]:.1f} s")
+                except Exception as e:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    failures[city_name] = f"{stage}: {e}"
+                    print(f"[{city_name}] {stage} failed, skipping the remaining stages of {city_name}")
+    finally:
+        cpu_executor.shutdown()
+        model_executor.shutdown()
+        io_executor.shutdown()
+
+    return timings, failures
+
+
+def format_summary(timings, failures, cities):
+    """Format the per-stage wall times of every city as a text table."""
+    stages = [stage for stage, _, _ in city_stages]
+    stages = [stage for stage in stages if any((city_name, stage) in timings for city_name in cities)]
+    width = max([len(stage) for stage in stages] + [len('total')])
+
+    lines = [f"{'stage':<{width}}  " + '  '.join(f"{city_name:>12}" for city_name in cities)]
+    for stage in stages:
+        cells = []
+        for city_name in cities:
+            elapsed = timings.get((city_name, stage))
+            cells.append(f"{elapsed:>11.1f}s" if elapsed is not None else f"{'-':>12}")
+        lines.append(f"{stage:<{width}}  " + '  '.join(cells))
+    totals = [sum(elapsed for (city, _), elapsed in timings.items() if city == city_name) for city_name in cities]
+    lines.append(f"{'total':<{width}}  " + '  '.join(f"{total:>11.1f}s" for total in totals))
+
+    for city_name, error in failures.items():
+        lines.append(f"{city_name} failed at {error}")
+    return '\n'.join(lines)
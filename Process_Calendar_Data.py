@@ -1,51 +1,148 @@
+import os
 import pandas as pd
+from .Instrumentation import instrumented
+from .Stage_Store import parquet_stage
 
-def process_city_calender(city_name):
-    base_path = "/content/calendar_{}{}.csv"
-    listings = []
 
-    # Read and log the number of rows for each file
+# Columns of the calendar files that are used by the later stages
+calendar_columns = ['listing_id', 'date', 'available', 'price']
+
+
+def truncate_to_month(dates):
+    """Set every date of a datetime Series to the first day of its month with a datetime64[M] cast."""
+    months = dates.to_numpy().astype('datetime64[M]').astype('datetime64[ns]')
+    return pd.Series(months, index=dates.index, name=dates.name)
+
+
+def parse_listing_ids(ids):
+    """
+    Convert listing ids read as strings (e.g. '123', '123.0') to int64 without a Python call per row.
+
+    Every id repeats once per calendar day, so only the distinct strings are parsed and the result is
+    broadcast back through the factorized codes. Plain integer strings are parsed exactly, so large ids
+    do not lose precision through float.
+    """
+    if pd.api.types.is_numeric_dtype(ids):
+        return ids.astype('int64')
+    codes, uniques = pd.factorize(ids)
+    if (codes < 0).any():
+        raise ValueError("Found missing listing ids that cannot be converted to integers")
+    uniques = pd.Series(uniques).astype(str).str.replace(r'\.0*$', '', regex=True)
+    parsed = pd.to_numeric(uniques).astype('int64').to_numpy()
+    return pd.Series(parsed[codes], index=ids.index, name=ids.name)
+
+
+def _stream_city_calender(city_name, base_path, chunksize):
+    """
+    Reads the calendar files chunk by chunk, filtering, truncating and deduplicating each chunk on arrival.
+
+    Only the deduplicated rows are kept between chunks, so peak memory is bounded by the size of the
+    output plus one chunk instead of the size of the raw files.
+    """
+    pending = []
+    pending_rows = 0
+    output_rows = 0
+
+    def compact(frames):
+        frame = pd.concat(frames, ignore_index=True)
+        return frame.drop_duplicates(subset=['listing_id', 'date'])
+
     for i in range(1, 5):
         file_path = base_path.format(city_name, i)
-        df = pd.read_csv(file_path, dtype=str, low_memory=False)
-        print(f"Rows in calendar_{city_name}{i}.csv: {df.shape[0]}")
-        listings.append(df)
+        rows_read = 0
+        reader = pd.read_csv(file_path, dtype=str, usecols=lambda column: column in calendar_columns, chunksize=chunksize)
+        for chunk in reader:
+            rows_read += chunk.shape[0]
 
-    # Concatenate all DataFrames into a single DataFrame
-    combined_calender = pd.concat(listings, ignore_index=True)
-    print(f"Initial combined rows: {combined_calender.shape[0]}")
+            # Filter unavailable days and unparseable dates as the chunk arrives
+            chunk = chunk[chunk['available'] != 'f']
+            chunk = chunk.assign(date=pd.to_datetime(chunk['date'], errors='coerce'))
+            chunk = chunk.dropna(subset=['date'])
 
-    # Filter the combined DataFrame
-    combined_calender = combined_calender[combined_calender['available'] != 'f']
-    print(f"Rows after filtering 'available' column: {combined_calender.shape[0]}")
+            # Truncate to the month and drop the duplicates inside the chunk
+            chunk = chunk.assign(date=truncate_to_month(chunk['date']))
+            chunk = chunk.drop_duplicates(subset=['listing_id', 'date'])
 
-    # Drop the specified columns
-    columns_to_drop = ['adjusted_price', 'minimum_nights', 'maximum_nights']
-    combined_calender = combined_calender.drop(columns=columns_to_drop, errors='ignore')
+            pending.append(chunk)
+            pending_rows += chunk.shape[0]
 
-    # Convert 'date' column to datetime, handling errors by coercing invalid dates to NaT
-    combined_calender['date'] = pd.to_datetime(combined_calender['date'], errors='coerce')
+            # Merge the pending chunks into a single deduplicated frame once the rows added since the last
+            # merge outgrow it, so every merge at least doubles the pending rows and the total work stays linear
+            if pending_rows - output_rows > max(output_rows, chunksize):
+                pending = [compact(pending)]
+                pending_rows = output_rows = pending[0].shape[0]
 
-    # Log the number of invalid dates
-    invalid_dates_count = combined_calender['date'].isna().sum()
-    print(f"Number of rows with invalid dates: {invalid_dates_count}")
+        print(f"Rows in calendar_{city_name}{i}.csv: {rows_read}")
 
-    # Drop rows with NaT in 'date' column
-    combined_calender = combined_calender.dropna(subset=['date'])
-    print(f"Rows after dropping invalid dates: {combined_calender.shape[0]}")
+    combined_calender = compact(pending)
+    print(f"Rows after streaming filter and dropping duplicates: {combined_calender.shape[0]}")
 
-    # Update 'date' column to have the first day of the month
-    combined_calender['date'] = combined_calender['date'].apply(lambda x: x.replace(day=1))
+    return combined_calender
 
-    # Sort the DataFrame by 'listing_id' and 'date'
-    combined_calender = combined_calender.sort_values(by=['listing_id', 'date'])
 
-    # Drop duplicates based on 'listing_id' and 'date' columns
-    combined_calender = combined_calender.drop_duplicates(subset=['listing_id', 'date'])
-    print(f"Rows after dropping duplicates: {combined_calender.shape[0]}")
+@instrumented
+@parquet_stage('calendar')
+def process_city_calender(city_name, dataset_dir='/content', chunksize=None):
+    """
+    Loads the four calendar snapshots of a city and reduces them to one available row per listing and month.
+
+    Args:
+    - city_name: Name of the city to load the calendar files for.
+    - dataset_dir: Directory containing the 'calendar_{city}{i}.csv' files.
+    - chunksize: If set, the files are streamed in chunks of this many rows and only the columns used
+      later are read, so peak memory is bounded by the output instead of the raw input.
+
+    Returns:
+    - combined_calender: DataFrame with integer 'listing_id' and month-start 'date' columns.
+    """
+    base_path = os.path.join(dataset_dir, "calendar_{}{}.csv")
+
+    if chunksize is not None:
+        combined_calender = _stream_city_calender(city_name, base_path, chunksize)
+    else:
+        listings = []
+
+        # Read and log the number of rows for each file
+        for i in range(1, 5):
+            file_path = base_path.format(city_name, i)
+            df = pd.read_csv(file_path, dtype=str, low_memory=False)
+            print(f"Rows in calendar_{city_name}{i}.csv: {df.shape[0]}")
+            listings.append(df)
+
+        # Concatenate all DataFrames into a single DataFrame
+        combined_calender = pd.concat(listings, ignore_index=True)
+        print(f"Initial combined rows: {combined_calender.shape[0]}")
+
+        # Filter the combined DataFrame
+        combined_calender = combined_calender[combined_calender['available'] != 'f']
+        print(f"Rows after filtering 'available' column: {combined_calender.shape[0]}")
+
+        # Drop the specified columns
+        columns_to_drop = ['adjusted_price', 'minimum_nights', 'maximum_nights']
+        combined_calender = combined_calender.drop(columns=columns_to_drop, errors='ignore')
+
+        # Convert 'date' column to datetime, handling errors by coercing invalid dates to NaT
+        combined_calender['date'] = pd.to_datetime(combined_calender['date'], errors='coerce')
+
+        # Log the number of invalid dates
+        invalid_dates_count = combined_calender['date'].isna().sum()
+        print(f"Number of rows with invalid dates: {invalid_dates_count}")
+
+        # Drop rows with NaT in 'date' column
+        combined_calender = combined_calender.dropna(subset=['date'])
+        print(f"Rows after dropping invalid dates: {combined_calender.shape[0]}")
+
+        # Update 'date' column to have the first day of the month
+        combined_calender['date'] = truncate_to_month(combined_calender['date'])
 
     # Ensure 'listing_id' is read as an integer
-    combined_calender['listing_id'] = combined_calender['listing_id'].apply(lambda x: int(float(x)))
+    combined_calender['listing_id'] = parse_listing_ids(combined_calender['listing_id'])
+
+    # Drop duplicates based on 'listing_id' and 'date' columns with a hash-based dedupe on the int64 keys
+    combined_calender = combined_calender.drop_duplicates(subset=['listing_id', 'date'])
+    print(f"Rows after dropping duplicates: {combined_calender.shape[0]}")
 
+    # Sort the much smaller deduplicated frame by 'listing_id' and 'date'
+    combined_calender = combined_calender.sort_values(by=['listing_id', 'date'], ignore_index=True)
 
-    return combined_calender
\ No newline at end of file
+    return combined_calender
@@ -1,9 +1,14 @@
+import os
 import pandas as pd
+from .Instrumentation import instrumented
+from .Stage_Store import parquet_stage
 
 
-def process_city_listings(city_name):
+@instrumented
+@parquet_stage('listings')
+def process_city_listings(city_name, dataset_dir='/content'):
     def load_listings(city):
-        base_path = "/content/{}_listings{}.csv"
+        base_path = os.path.join(dataset_dir, "{}_listings{}.csv")
         listings = []
         for i in range(1, 5):
             file_path = base_path.format(city, i)
@@ -12,7 +17,7 @@ def process_city_listings(city_name):
         return combined_listings
 
     def load_listings_long(city):
-        base_path = "/content/{}_listings{}_long.csv"
+        base_path = os.path.join(dataset_dir, "{}_listings{}_long.csv")
         listings_long = []
         for i in range(1, 5):
             file_path = base_path.format(city, i)
@@ -44,7 +49,7 @@ def process_city_listings(city_name):
     combined_listings_extended['review_scores_rating'] = combined_listings_extended['review_scores_rating'].astype(float).fillna(mean_review_score)
 
     # Fill NaN values in 'description' with values from 'name'
-    combined_listings_extended['description'].fillna(combined_listings_extended['name'], inplace=True)
+    combined_listings_extended['description'] = combined_listings_extended['description'].fillna(combined_listings_extended['name'])
 
     # Ensure the data type of id
     combined_listings_extended['id'] = combined_listings_extended['id'].astype(int)
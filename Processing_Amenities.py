@@ -1,42 +1,157 @@
+import os
+import numpy as np
 import pandas as pd
-from collections import Counter
-
-def process_combined_data(combined_data):
-    # Function to handle amenities column
-    def handle_amenities(amenities):
-        if isinstance(amenities, str):
-            # Remove brackets, quotes, and split by commas
-            return amenities.strip("[]").replace('"', '').split(", ")
-        elif isinstance(amenities, list):
-            # Directly convert the list to a space-separated string
-            return amenities
-        else:
-            # Handle other unexpected types
-            return []
-
-    # Apply the function to the 'amenities' column
-    combined_data['amenities_list'] = combined_data['amenities'].apply(handle_amenities)
-
-    # Function to get top amenities with frequencies as percentages for each neighborhood
-    def get_top_amenities_with_percentages(group, top_n=10):
-        # Flatten the list of amenities for the current neighborhood
-        all_amenities = [amenity for sublist in group for amenity in sublist]
-        # Count the frequency of each amenity
-        amenity_counts = Counter(all_amenities)
-        # Calculate the total number of listings in the neighborhood
-        total_listings = len(group)
-        # Get the top_n amenities with their counts and calculate percentages
-        top_amenities_with_percentages = [(amenity, count, (count / total_listings) * 100) for amenity, count in amenity_counts.most_common(top_n)]
-        # Format the result as "Amenity (Count, Percentage%)"
-        return ', '.join([f"{amenity} ({count}, {percentage:.2f}%)" for amenity, count, percentage in top_amenities_with_percentages])
-
-    # Create a new DataFrame to store the top amenities with percentages for each neighborhood
-    neighborhood_top_amenities_with_percentages = combined_data.groupby('neighbourhood_cleansed')['amenities_list'].apply(get_top_amenities_with_percentages).reset_index()
-
-    # Rename the columns for clarity
-    neighborhood_top_amenities_with_percentages.columns = ['neighbourhood_cleansed', 'top_amenities_with_percentages']
-
-    # Merge the top amenities with percentages back into the original DataFrame
-    combined_data = pd.merge(combined_data, neighborhood_top_amenities_with_percentages, on='neighbourhood_cleansed', how='left')
+from typing import NamedTuple
+from scipy import sparse
+from .Instrumentation import instrumented
+from .Stage_Store import load_parquet, parquet_stage, save_parquet
+
+
+class AmenityIndex(NamedTuple):
+    """
+    Binary listing x amenity matrix built once per unique listing.
+
+    - listing_ids: Array with the listing id of every matrix row.
+    - neighbourhoods: Array with the neighbourhood of every matrix row.
+    - vocabulary: Array with the amenity name of every matrix column.
+    - matrix: scipy CSR matrix, 1 where the listing has the amenity.
+    """
+    listing_ids: np.ndarray
+    neighbourhoods: np.ndarray
+    vocabulary: np.ndarray
+    matrix: sparse.csr_matrix
+
+
+# Function to handle amenities column
+def parse_amenities(amenities):
+    if isinstance(amenities, str):
+        # Remove brackets, quotes, and split by commas
+        return amenities.strip("[]").replace('"', '').split(", ")
+    elif isinstance(amenities, list):
+        # Lists are already parsed
+        return amenities
+    else:
+        # Handle other unexpected types
+        return []
+
+
+@instrumented
+def build_amenity_index(combined_data):
+    """
+    Builds the amenity vocabulary and a sparse listing x amenity matrix from one row per listing.
+
+    Args:
+    - combined_data: DataFrame with 'id', 'neighbourhood_cleansed' and 'amenities' columns, possibly
+      repeated per calendar month.
+
+    Returns:
+    - index: An AmenityIndex.
+    """
+    listings = combined_data.drop_duplicates(subset=['id'])[['id', 'neighbourhood_cleansed', 'amenities']]
+
+    # Parse every listing once and flatten to (listing row, amenity) pairs
+    amenities = listings['amenities'].astype(object).map(parse_amenities)
+    pairs = pd.DataFrame({'row': np.arange(len(listings)), 'amenity': amenities.to_numpy()}).explode('amenity')
+    pairs = pairs[pairs['amenity'].notna() & (pairs['amenity'] != '')]
+
+    columns, vocabulary = pd.factorize(pairs['amenity'])
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (pairs['row'].to_numpy(dtype=np.int64), columns)),
+        shape=(len(listings), len(vocabulary)),
+    )
+    # Count an amenity listed twice by the same listing only once
+    matrix.data[:] = 1
+
+    return AmenityIndex(
+        listing_ids=listings['id'].to_numpy(),
+        neighbourhoods=listings['neighbourhood_cleansed'].to_numpy(),
+        vocabulary=np.asarray(vocabulary, dtype=object),
+        matrix=matrix,
+    )
+
+
+def top_amenities_by_neighbourhood(index, top_n=10):
+    """
+    Computes the top_n amenities of every neighbourhood with a sparse groupby-sum over the amenity matrix.
+
+    Returns:
+    - top_amenities: Series mapping each neighbourhood to "Amenity (Count, Percentage%), ..." where the
+      percentage is relative to the number of listings in the neighbourhood.
+    """
+    neighbourhood_codes, neighbourhoods = pd.factorize(pd.Series(index.neighbourhoods))
+    valid = neighbourhood_codes >= 0
+
+    # Neighbourhood x listing indicator matrix; multiplying it with the amenity matrix sums per neighbourhood
+    membership = sparse.csr_matrix(
+        (np.ones(valid.sum(), dtype=np.float32), (neighbourhood_codes[valid], np.flatnonzero(valid))),
+        shape=(len(neighbourhoods), len(index.listing_ids)),
+    )
+    counts = (membership @ index.matrix).toarray()
+    total_listings = np.asarray(membership.sum(axis=1)).ravel()
+
+    top_amenities = {}
+    for row, neighbourhood in enumerate(neighbourhoods):
+        top = np.argsort(-counts[row], kind='stable')[:top_n]
+        top = top[counts[row, top] > 0]
+        top_amenities[neighbourhood] = ', '.join(
+            f"{index.vocabulary[column]} ({int(counts[row, column])}, {counts[row, column] / total_listings[row] * 100:.2f}%)"
+            for column in top
+        )
+    return pd.Series(top_amenities, name='top_amenities_with_percentages')
+
+
+def save_amenity_index(index, directory):
+    """Save an AmenityIndex as 'amenity_matrix.npz' plus Parquet files for the rows and the vocabulary."""
+    os.makedirs(directory, exist_ok=True)
+    sparse.save_npz(os.path.join(directory, 'amenity_matrix.npz'), index.matrix)
+    save_parquet(pd.DataFrame({'id': index.listing_ids, 'neighbourhood_cleansed': index.neighbourhoods}),
+                 os.path.join(directory, 'amenity_rows.parquet'))
+    save_parquet(pd.DataFrame({'amenity': index.vocabulary}), os.path.join(directory, 'amenity_vocabulary.parquet'))
+
+
+@instrumented
+def load_amenity_index(directory):
+    rows = load_parquet(os.path.join(directory, 'amenity_rows.parquet'))
+    vocabulary = load_parquet(os.path.join(directory, 'amenity_vocabulary.parquet'))
+    return AmenityIndex(
+        listing_ids=rows['id'].to_numpy(),
+        neighbourhoods=rows['neighbourhood_cleansed'].to_numpy(),
+        vocabulary=vocabulary['amenity'].to_numpy(dtype=object),
+        matrix=sparse.load_npz(os.path.join(directory, 'amenity_matrix.npz')).tocsr(),
+    )
+
+
+@instrumented
+@parquet_stage('amenities', inputs={'combined_data': 'previous'})
+def process_combined_data(combined_data, top_n=10, index_dir=None):
+    """
+    Adds the parsed amenities of every listing and the top amenities of its neighbourhood.
+
+    Amenities are counted once per listing, not once per calendar-month row.
+
+    Args:
+    - combined_data: The DataFrame containing 'id', 'neighbourhood_cleansed' and 'amenities' columns.
+    - top_n: Number of amenities listed per neighbourhood.
+    - index_dir: If given, the amenity index is saved there for downstream consumers (see load_amenity_index).
+
+    Returns:
+    - combined_data: The updated DataFrame with 'amenities_list' and 'top_amenities_with_percentages' columns.
+    """
+    index = build_amenity_index(combined_data)
+    print(f"Amenity index: {index.matrix.shape[0]} listings x {index.matrix.shape[1]} amenities")
+    if index_dir is not None:
+        save_amenity_index(index, index_dir)
+
+    # Broadcast the parsed amenities of each listing to all of its rows
+    listing_amenities = pd.Series(
+        [list(index.vocabulary[index.matrix.indices[start:end]]) for start, end in zip(index.matrix.indptr[:-1], index.matrix.indptr[1:])],
+        index=index.listing_ids,
+    )
+    combined_data = combined_data.copy()
+    combined_data['amenities_list'] = combined_data['id'].map(listing_amenities)
+
+    # Map the top amenities with percentages of each neighbourhood back to its rows
+    top_amenities = top_amenities_by_neighbourhood(index, top_n)
+    combined_data['top_amenities_with_percentages'] = combined_data['neighbourhood_cleansed'].map(top_amenities)
 
     return combined_data
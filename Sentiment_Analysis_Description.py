@@ -1,33 +1,39 @@
 
 
-import torch
-from transformers import pipeline
+import pandas as pd
 from tqdm import tqdm
+from .Description_Dedup import deduplicate_texts
+from .Inference_Cache import get_inference_cache
+from .Instrumentation import instrumented
+from .Model_Registry import get_pipeline, model_key, sentiment_model_name
+from .Stage_Store import parquet_stage
 
-def analyze_sentiment(combined_data, batch_size=32):
+@instrumented
+@parquet_stage('description_sentiment', inputs={'combined_data': 'previous'})
+def analyze_sentiment(combined_data, batch_size=32, cache=None, backend="torch", model_name=None, dedup_threshold=None):
     """
     Performs sentiment analysis on property descriptions.
 
+    Each unique description is scored once and the result is broadcast to every
+    calendar-month row of that listing.
+
     Args:
     - combined_data: The DataFrame containing property descriptions.
-    - batch_size: The size of batches for processing descriptions.
+    - batch_size: The size of batches for processing description chunks.
+    - cache: Optional InferenceCache (or path to one); only chunks missing from it are sent through the model.
+    - backend: Inference backend, "torch", "torch-int8" or "onnx" (see Model_Registry.check_backend_agreement).
+    - model_name: Sentiment model to use instead of the default one, e.g. a local stub model for benchmarks.
+    - dedup_threshold: If set, near-duplicate descriptions at this MinHash similarity are clustered and only one
+      description per cluster is scored; its result is given to the whole cluster (see Description_Dedup).
 
     Returns:
     - combined_data: The updated DataFrame with added 'Positivity_Score(1to5)' and 'sentiment_score' columns.
     """
     # Use a publicly available multilingual sentiment analysis model
-    model_name = "nlptown/bert-base-multilingual-uncased-sentiment"
-    device = 0 if torch.cuda.is_available() else -1
-
-    # Initialize the sentiment analysis pipeline
-    sentiment_analyzer = pipeline(
-        "sentiment-analysis",
-        model=model_name,
-        tokenizer=model_name,
-        device=device,
-        framework='pt',
-        truncation=True
-    )
+    model_name = model_name or sentiment_model_name
+
+    # Get the shared sentiment analysis pipeline, loaded once per process
+    sentiment_analyzer = get_pipeline("sentiment-analysis", model_name, backend)
 
     def split_text(text, max_length=512):
         """Split text into chunks that fit within the maximum length."""
@@ -39,24 +45,65 @@ def analyze_sentiment(combined_data, batch_size=32):
         sentiments = []
         for i in tqdm(range(0, len(texts), batch_size), desc="Processing Batches"):
             batch = texts[i:i+batch_size]
-            batch_split = [chunk for text in batch for chunk in split_text(text)]
-            batch_results = sentiment_analyzer(batch_split)
+            batch_results = sentiment_analyzer(batch)
             sentiments.extend(batch_results)
         return sentiments
 
-    def process_sentiment_results(results):
-        """Process sentiment results to extract labels and scores."""
-        labels = [result['label'] for result in results]
-        scores = [result['score'] for result in results]
-        return labels, scores
+    def aggregate_chunk_results(chunk_results):
+        """Reduce the chunk results of one description to a single label and score."""
+        # The label with the highest summed confidence wins
+        label_weights = {}
+        for result in chunk_results:
+            label_weights[result['label']] = label_weights.get(result['label'], 0.0) + result['score']
+        label = max(label_weights, key=label_weights.get)
+        # The score is the mean confidence of the chunks carrying the winning label
+        scores = [result['score'] for result in chunk_results if result['label'] == label]
+        return label, sum(scores) / len(scores)
+
+    # Keep one entry per unique description; repeated (id, description) month rows collapse here
+    descriptions = combined_data['description'].dropna().astype(str)
+    texts = descriptions.unique()
+    print(f"Scoring {len(texts)} unique descriptions for {len(combined_data)} rows")
+
+    # Optionally score one representative per cluster of near-duplicate descriptions
+    scored_texts, representative_of = texts, None
+    if dedup_threshold is not None:
+        scored_texts, representative_of, _ = deduplicate_texts(texts, dedup_threshold)
 
-    # Apply sentiment analysis in batches
-    descriptions = combined_data['description'].tolist()
-    sentiment_results = get_sentiment_scores_batch(descriptions, batch_size)
-    sentiment_labels, sentiment_scores = process_sentiment_results(sentiment_results)
+    # Split every description into chunks, remembering which description each chunk belongs to
+    chunks = []
+    owners = []
+    for owner, text in enumerate(scored_texts):
+        for chunk in split_text(text):
+            chunks.append(chunk)
+            owners.append(owner)
+
+    # Apply sentiment analysis in batches over the flat chunk list, skipping cached chunks
+    cache = get_inference_cache(cache)
+    if cache is None:
+        chunk_results = get_sentiment_scores_batch(chunks, batch_size)
+    else:
+        chunk_results = cache.cached_map(chunks, get_sentiment_scores_batch, model_key(model_name, backend), "sentiment-analysis")
+        print(f"Inference cache: {cache.stats()}")
+
+    # Group the chunk results back per description
+    results_per_text = [[] for _ in scored_texts]
+    for owner, result in zip(owners, chunk_results):
+        results_per_text[owner].append(result)
+    sentiments = [aggregate_chunk_results(results) if results else (None, None) for results in results_per_text]
+
+    # Give every description the result of its representative
+    if representative_of is not None:
+        sentiments = [sentiments[representative] for representative in representative_of]
+
+    sentiment_by_text = pd.DataFrame(
+        sentiments,
+        index=texts,
+        columns=['Positivity_Score(1to5)', 'sentiment_score']
+    )
 
-    # Add the sentiment results to the DataFrame
-    combined_data['Positivity_Score(1to5)'] = sentiment_labels
-    combined_data['sentiment_score'] = sentiment_scores
+    # Broadcast the results to every row with a vectorized map on the description text
+    combined_data['Positivity_Score(1to5)'] = descriptions.map(sentiment_by_text['Positivity_Score(1to5)'])
+    combined_data['sentiment_score'] = descriptions.map(sentiment_by_text['sentiment_score'])
 
-    return combined_data
\ No newline at end of file
+    return combined_data
@@ -1,10 +1,147 @@
 import os
+import queue
+import threading
+import time
+import numpy as np
 import pandas as pd
 import torch
-from transformers import pipeline
 from tqdm import tqdm
+from .Data_Schema import apply_schema
+from .Inference_Cache import get_inference_cache
+from .Instrumentation import instrumented
+from .Model_Registry import get_pipeline, model_key, sentiment_model_name
+from .Stage_Store import parquet_stage
 
-def process_city_reviews(combined_data, city, dataset_dir='/content', start_date='2023-07-01', end_date='2024-06-30', filename='florence_final_data.csv'):
+
+# Columns of the review files that are used
+review_columns = ['listing_id', 'date', 'comments']
+
+# Reviews scored by default, by date
+review_start_date = '2023-07-01'
+review_end_date = '2024-06-30'
+
+
+def _review_chunks(base_path, listing_ids, start_date, end_date, chunksize):
+    """Yields the (listing_id, comments) of the reviews in the date range and of known listings, chunk by chunk."""
+    for i in range(1, 5):
+        file_path = base_path.format(i)
+        rows_read = rows_kept = 0
+        reader = pd.read_csv(file_path, usecols=review_columns, dtype={'listing_id': 'Int64'}, chunksize=chunksize)
+        for chunk in reader:
+            rows_read += chunk.shape[0]
+
+            # Filter on date and listing as the chunk arrives, before touching the comments
+            dates = pd.to_datetime(chunk['date'], errors='coerce')
+            chunk = chunk[(dates >= start_date) & (dates <= end_date) & chunk['listing_id'].isin(listing_ids)]
+            if chunk.empty:
+                continue
+            rows_kept += chunk.shape[0]
+
+            comments = [str(comment) if pd.notna(comment) else '' for comment in chunk['comments']]
+            yield chunk['listing_id'].to_numpy(dtype='int64'), comments
+
+        print(f"Reviews in {os.path.basename(file_path)}: {rows_read}, kept after date and listing filter: {rows_kept}")
+
+
+def _stream_review_sentiment(base_path, listing_ids, start_date, end_date, chunksize, sentiment_analyzer,
+                             cache=None, cache_model=None, batch_size=256, max_length=512, queue_size=8):
+    """
+    Scores the reviews chunk by chunk and keeps only a running (sum, count) of the sentiment score per listing.
+
+    A reader thread reads, filters and tokenizes the next batches while the model runs on the current one,
+    through a bounded queue, so memory does not grow with the number of reviews. With a cache the reader
+    only batches the texts: the batches are tokenized once the cache has dropped the known ones.
+
+    Returns:
+    - average_sentiment: DataFrame with 'listing_id' and 'average_sentiment_score' per reviewed listing.
+    """
+    tokenizer = sentiment_analyzer.tokenizer
+    model = sentiment_analyzer.model
+    id2label = model.config.id2label
+
+    listing_ids = np.unique(np.asarray(listing_ids, dtype='int64'))
+    score_sums = np.zeros(len(listing_ids))
+    score_counts = np.zeros(len(listing_ids), dtype='int64')
+
+    def tokenize(texts):
+        return tokenizer(texts, truncation=True, padding=True, return_tensors='pt')
+
+    def score(inputs, items):
+        """Run the model on tokenized inputs and return pipeline-style {'label', 'score'} results."""
+        start = time.perf_counter()
+        with torch.no_grad():
+            probabilities = model(**inputs.to(model.device)).logits.softmax(dim=-1)
+        if hasattr(sentiment_analyzer, 'record'):
+            sentiment_analyzer.record(items, time.perf_counter() - start)
+        best_scores, best_ids = probabilities.max(dim=-1)
+        return [{'label': id2label[best], 'score': value} for best, value in zip(best_ids.tolist(), best_scores.tolist())]
+
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer has stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for chunk_ids, comments in _review_chunks(base_path, listing_ids, start_date, end_date, chunksize):
+                for i in range(0, len(comments), batch_size):
+                    # Truncate texts to max_length characters, as in the non-streaming mode and its cache keys
+                    texts = [comment[:max_length] for comment in comments[i:i + batch_size]]
+                    put((chunk_ids[i:i + batch_size], texts, None if cache is not None else tokenize(texts)))
+                    if stop.is_set():
+                        return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=produce, name="review-reader", daemon=True)
+    reader.start()
+    reviews = 0
+    try:
+        with tqdm(desc="Processing Reviews", unit=" reviews") as progress:
+            while True:
+                item = batches.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                batch_ids, texts, inputs = item
+                if inputs is None:
+                    results = cache.cached_map(texts, lambda missing: score(tokenize(missing), len(missing)), cache_model, "sentiment-analysis")
+                else:
+                    results = score(inputs, len(texts))
+
+                # Add the batch to the running per-listing aggregates
+                positions = np.searchsorted(listing_ids, batch_ids)
+                np.add.at(score_sums, positions, [result['score'] for result in results])
+                np.add.at(score_counts, positions, 1)
+                reviews += len(texts)
+                progress.update(len(texts))
+    finally:
+        stop.set()
+        reader.join()
+
+    print(f"Scored {reviews} reviews in streaming mode")
+    reviewed = score_counts > 0
+    return pd.DataFrame({
+        'listing_id': listing_ids[reviewed],
+        'average_sentiment_score': score_sums[reviewed] / score_counts[reviewed],
+    })
+
+
+@instrumented
+@parquet_stage('review_sentiment', inputs={'combined_data': 'previous'})
+def process_city_reviews(combined_data, city, dataset_dir='/content', start_date=review_start_date, end_date=review_end_date, filename='florence_final_data.csv', cache=None, backend="torch", model_name=None,
+                         chunksize=None):
     """
     Load, preprocess, perform sentiment analysis on reviews, and merge results into combined_data DataFrame for a given city.
 
@@ -14,37 +151,47 @@ def process_city_reviews(combined_data, city, dataset_dir='/content', start_date
     - start_date: Start date for filtering reviews (format 'YYYY-MM-DD').
     - end_date: End date for filtering reviews (format 'YYYY-MM-DD').
     - filename: Filename of the combined data CSV file.
+    - cache: Optional InferenceCache (or path to one); only reviews missing from it are sent through the model.
+    - backend: Inference backend, "torch", "torch-int8" or "onnx" (see Model_Registry.check_backend_agreement).
+    - model_name: Sentiment model to use instead of the default one, e.g. a local stub model for benchmarks.
+    - chunksize: If set, the review files are streamed in chunks of this many rows and only a running
+      per-listing score is kept, so memory does not grow with the number of reviews.
 
     Returns:
     - combined_data: DataFrame with added 'Positivity_Scores(1to5)' column.
     """
-
-    # Function to optimize memory usage
-    def optimize_memory(df):
-        for col in df.select_dtypes(include=['float']):
-            df[col] = pd.to_numeric(df[col], downcast='float')
-        for col in df.select_dtypes(include=['int']):
-            df[col] = pd.to_numeric(df[col], downcast='integer')
-        for col in df.select_dtypes(include=['object']):
-            num_unique_values = len(df[col].unique())
-            num_total_values = len(df[col])
-            if num_unique_values / num_total_values < 0.5:
-                df[col] = df[col].astype('category')
-        return df
-
-    # Load and preprocess reviews
     base_path = os.path.join(dataset_dir, f"{city}_reviews{{}}.csv")
+
+    # Use a publicly available multilingual sentiment analysis model
+    model_name = model_name or sentiment_model_name
+
+    # Get the shared sentiment analysis pipeline, loaded once per process
+    sentiment_analyzer = get_pipeline("sentiment-analysis", model_name, backend)
+    cache = get_inference_cache(cache)
+
+    if chunksize is not None:
+        average_sentiment = _stream_review_sentiment(base_path, combined_data['id'].unique(), pd.Timestamp(start_date),
+                                                     pd.Timestamp(end_date), chunksize, sentiment_analyzer,
+                                                     cache=cache, cache_model=model_key(model_name, backend))
+        if cache is not None:
+            print(f"Inference cache: {cache.stats()}")
+    else:
+        average_sentiment = _average_review_sentiment(combined_data, base_path, start_date, end_date, sentiment_analyzer,
+                                                      cache=cache, cache_model=model_key(model_name, backend))
+
+    return _merge_review_sentiment(combined_data, average_sentiment)
+
+
+def _average_review_sentiment(combined_data, base_path, start_date, end_date, sentiment_analyzer, cache=None, cache_model=None):
+    """Scores all reviews in the date range at once and averages the sentiment score per listing."""
+    # Load only the used review columns, cast to the typed schema
     reviews = []
     for i in range(1, 5):
         file_path = base_path.format(i)
-        df = pd.read_csv(file_path)
-        df = optimize_memory(df)
-        reviews.append(df)
+        df = pd.read_csv(file_path, usecols=review_columns)
+        reviews.append(apply_schema(df, text_dtype='string[pyarrow]'))
     florence_reviews = pd.concat(reviews, ignore_index=True)
 
-    # Drop unnecessary columns
-    florence_reviews.drop(columns=['reviewer_id', 'reviewer_name', 'id'], inplace=True)
-
     # Ensure 'date' column is in datetime format
     florence_reviews['date'] = pd.to_datetime(florence_reviews['date'], errors='coerce')
 
@@ -61,15 +208,6 @@ def process_city_reviews(combined_data, city, dataset_dir='/content', start_date
     # Filter florence_reviews to keep only rows where listing_id is in ids_set
     florence_reviews = florence_reviews[florence_reviews['listing_id'].isin(ids_set)]
 
-    # Check if GPU is available and set device
-    device = 0 if torch.cuda.is_available() else -1
-
-    # Use a publicly available multilingual sentiment analysis model
-    model_name = "nlptown/bert-base-multilingual-uncased-sentiment"
-
-    # Initialize the sentiment analysis pipeline
-    sentiment_analyzer = pipeline("sentiment-analysis", model=model_name, tokenizer=model_name, device=device)
-
     # Function to clean and prepare comments
     def prepare_comments(comments):
         return [str(comment) if pd.notna(comment) else '' for comment in comments]
@@ -96,7 +234,13 @@ def process_city_reviews(combined_data, city, dataset_dir='/content', start_date
     # Prepare comments
     comments = prepare_comments(florence_reviews['comments'].tolist())
     batch_size = 256
-    sentiment_results = get_sentiment_scores_batch(comments, batch_size)
+    if cache is None:
+        sentiment_results = get_sentiment_scores_batch(comments, batch_size)
+    else:
+        # Key on the truncated text, which is what the model actually sees
+        truncated_comments = [comment[:512] for comment in comments]
+        sentiment_results = cache.cached_map(truncated_comments, get_sentiment_scores_batch, cache_model, "sentiment-analysis")
+        print(f"Inference cache: {cache.stats()}")
     sentiment_labels, sentiment_scores = process_sentiment_results(sentiment_results)
 
     # Add the sentiment results to the florence_reviews DataFrame
@@ -109,38 +253,32 @@ def process_city_reviews(combined_data, city, dataset_dir='/content', start_date
     # Rename the column to 'average_sentiment_score'
     average_sentiment.rename(columns={'sentiment_score': 'average_sentiment_score'}, inplace=True)
 
-    # Merge the average sentiment scores back into the original DataFrame
-    florence_reviews = pd.merge(florence_reviews, average_sentiment, on='listing_id', how='left')
-
-    # Define a function to assign star labels based on the average sentiment score
-    def assign_star_label(avg_score):
-        if 0.00 <= avg_score <= 0.20:
-            return "1 star"
-        elif 0.21 <= avg_score <= 0.40:
-            return "2 stars"
-        elif 0.41 <= avg_score <= 0.60:
-            return "3 stars"
-        elif 0.61 <= avg_score <= 0.80:
-            return "4 stars"
-        elif 0.81 <= avg_score <= 1.00:
-            return "5 stars"
-        else:
-            return "Unknown"
-
-    # Apply the function to the 'average_sentiment_score' column to create a new 'Customer_Positivity_Ranking(1to5)' column
-    florence_reviews['Customer_Positivity_Ranking(1to5)'] = florence_reviews['average_sentiment_score'].apply(assign_star_label)
-
-    # Merge the 'Customer_Positivity_Ranking(1to5)' column from florence_reviews into combined_data based on the listing_id and id
+    return average_sentiment
+
+
+def _merge_review_sentiment(combined_data, average_sentiment):
+    """Assigns star labels to the per-listing average scores and joins them to combined_data."""
+    # Assign star labels to the per-listing averages with a single vectorized binning pass.
+    # Bins are closed on the right, so scores such as 0.205 no longer fall between two labels.
+    star_bins = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0]
+    star_labels = ["1 star", "2 stars", "3 stars", "4 stars", "5 stars"]
+    average_sentiment['Customer_Positivity_Ranking(1to5)'] = pd.cut(
+        average_sentiment['average_sentiment_score'], bins=star_bins, labels=star_labels, include_lowest=True
+    ).astype(object).fillna("Unknown")
+
+    # Join one row per listing, so calendar rows are not duplicated once per review
     updated_combined_data = pd.merge(combined_data,
-                                     florence_reviews[['listing_id', 'Customer_Positivity_Ranking(1to5)']],
+                                     average_sentiment[['listing_id', 'Customer_Positivity_Ranking(1to5)']],
                                      left_on='id',
                                      right_on='listing_id',
-                                     how='left')
+                                     how='left',
+                                     validate='many_to_one')
+    print(f"Rows before/after review join: {len(combined_data)}/{len(updated_combined_data)}")
 
     # Drop the 'listing_id' column if it's not needed in combined_data
     updated_combined_data.drop(columns=['listing_id'], inplace=True)
 
     # Fill missing values in 'Customer_Positivity_Ranking(1to5)' with "No reviews found"
-    updated_combined_data['Customer_Positivity_Ranking(1to5)'].fillna("No reviews found", inplace=True)
+    updated_combined_data['Customer_Positivity_Ranking(1to5)'] = updated_combined_data['Customer_Positivity_Ranking(1to5)'].fillna("No reviews found")
 
-    return updated_combined_data
\ No newline at end of file
+    return updated_combined_data
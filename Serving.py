@@ -0,0 +1,273 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from .Instrumentation import instrumented
+from .Stage_Store import stage_path
+
+
+# Columns of the final data used by the aggregates; the listing text columns are never loaded
+served_columns = [
+    'id', 'date', 'price', 'neighbourhood_cleansed', 'category', 'top_amenities_with_percentages',
+    'sentiment_score', 'Positivity_Score(1to5)', 'Customer_Positivity_Ranking(1to5)',
+]
+
+# Aggregates served per city, each indexed by neighbourhood
+aggregates = ('prices', 'categories', 'sentiment', 'amenities')
+
+# Entries such as "Wifi (111, 100.00%)" of 'top_amenities_with_percentages'
+amenity_pattern = re.compile(r'(.+?) \((\d+), ([\d.]+)%\)(?:, |$)')
+
+
+def final_data_path(city_dir, city_name):
+    """Path of the final data of a city: the 'final' stage file, else the '{city}_final_data.parquet' output."""
+    path = stage_path(city_dir, 'final')
+    if os.path.exists(path):
+        return path
+    path = os.path.join(city_dir, f"{city_name}_final_data.parquet")
+    return path if os.path.exists(path) else None
+
+
+def load_final_data(path):
+    """Reads only the served columns of a final data file through a memory map."""
+    names = pq.read_schema(path).names
+    table = pq.read_table(path, columns=[column for column in served_columns if column in names], memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _records(df):
+    """DataFrame rows as JSON-ready dicts, with NaN/NA as None."""
+    df = df.astype(object).where(df.notna(), None)
+    return [
+        {key: value.item() if isinstance(value, np.generic) else value for key, value in row.items()}
+        for row in df.to_dict(orient='records')
+    ]
+
+
+def _by_neighbourhood(records):
+    index = {}
+    for record in records:
+        index.setdefault(record['neighbourhood'], []).append(record)
+    return index
+
+
+def parse_top_amenities(text):
+    """Splits a 'top_amenities_with_percentages' string into [{'amenity', 'listings', 'percentage'}]."""
+    if not isinstance(text, str):
+        return []
+    return [
+        {'amenity': amenity, 'listings': int(count), 'percentage': float(percentage)}
+        for amenity, count, percentage in amenity_pattern.findall(text)
+    ]
+
+
+@instrumented
+def compute_aggregates(final_data):
+    """
+    Precomputes the aggregates served for one city.
+
+    Args:
+    - final_data: The final data of a city, with forecast rows (no listing 'id') appended by arima_forecast_and_save.
+
+    Returns:
+    - aggregates: Dict mapping each name of `aggregates` to a dict of records per neighbourhood.
+    """
+    data = final_data.rename(columns={'neighbourhood_cleansed': 'neighbourhood'})
+    data['neighbourhood'] = data['neighbourhood'].astype(str)
+    forecast = data['id'].isna()
+
+    # Monthly mean price per neighbourhood, including the forecast months
+    prices = data.assign(forecast=forecast, month=data['date'].dt.strftime('%Y-%m')).groupby(
+        ['neighbourhood', 'month', 'forecast'], observed=True, sort=True
+    )['price'].mean().rename('mean_price').reset_index()
+
+    # Everything else counts listings once, not once per calendar month
+    listings = data[~forecast].drop_duplicates(subset=['id'])
+
+    categories = pd.DataFrame(columns=['neighbourhood', 'category', 'listings', 'share'])
+    if 'category' in listings:
+        counts = listings.groupby(['neighbourhood', 'category'], observed=True).size().rename('listings').reset_index()
+        counts['share'] = counts['listings'] / counts.groupby('neighbourhood')['listings'].transform('sum')
+        categories = counts.sort_values(['neighbourhood', 'listings'], ascending=[True, False])
+
+    # Neighbourhoods ranked by mean description sentiment, with the label distributions of their listings
+    sentiment = []
+    if 'sentiment_score' in listings:
+        means = listings.groupby('neighbourhood')['sentiment_score'].mean().sort_values(ascending=False)
+        label_columns = [column for column in ('Positivity_Score(1to5)', 'Customer_Positivity_Ranking(1to5)') if column in listings]
+        groups = dict(tuple(listings.groupby('neighbourhood')))
+        for rank, (neighbourhood, mean_score) in enumerate(means.items(), start=1):
+            group = groups[neighbourhood]
+            record = {
+                'neighbourhood': neighbourhood,
+                'rank': rank,
+                'listings': len(group),
+                'mean_sentiment_score': None if pd.isna(mean_score) else float(mean_score),
+            }
+            for column in label_columns:
+                record[column] = {str(label): int(count) for label, count in group[column].value_counts().items()}
+            sentiment.append(record)
+
+    amenities = []
+    if 'top_amenities_with_percentages' in listings:
+        top = listings.dropna(subset=['top_amenities_with_percentages']).drop_duplicates(subset=['neighbourhood'])
+        amenities = [
+            {'neighbourhood': neighbourhood, 'top_amenities': parse_top_amenities(text)}
+            for neighbourhood, text in zip(top['neighbourhood'], top['top_amenities_with_percentages'].astype(str))
+        ]
+
+    return {
+        'prices': _by_neighbourhood(_records(prices)),
+        'categories': _by_neighbourhood(_records(categories)),
+        'sentiment': _by_neighbourhood(sentiment),
+        'amenities': _by_neighbourhood(amenities),
+    }
+
+
+class QueryService:
+    """
+    Read-only queries over the final data of the cities in a work directory.
+
+    The aggregates of every city are computed once at startup; the final data itself is not kept.
+    Encoded responses are cached per path and query string, so repeated dashboard requests cost a dict lookup.
+
+    Routes:
+    - /cities: The served cities.
+    - /cities/{city}/neighbourhoods: The neighbourhoods of a city.
+    - /cities/{city}/{aggregate}[?neighbourhood=...]: One of `aggregates`, optionally for one neighbourhood.
+    """
+
+    def __init__(self, workdir, cities=None, cache_size=1024):
+        self.workdir = workdir
+        self.cache_size = cache_size
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if cities is None:
+            cities = sorted(name for name in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, name)))
+        self.cities = {}
+        for city_name in cities:
+            path = final_data_path(os.path.join(workdir, city_name), city_name)
+            if path is None:
+                print(f"No final data for {city_name} in {workdir}, skipping")
+                continue
+            self.cities[city_name] = compute_aggregates(load_final_data(path))
+            print(f"Serving {city_name} from {path}")
+
+    def query(self, path, query_string=''):
+        """
+        Returns the response to a GET request.
+
+        Returns:
+        - status: HTTP status code.
+        - body: JSON-encoded response body.
+        """
+        key = (path, query_string)
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                self.hits += 1
+                return self._responses[key]
+            self.misses += 1
+
+        status, payload = self._resolve(path, parse_qs(query_string))
+        response = (status, json.dumps(payload).encode())
+
+        # Cache only successful responses, the aggregates never change while serving
+        if status == 200:
+            with self._lock:
+                self._responses[key] = response
+                if len(self._responses) > self.cache_size:
+                    self._responses.popitem(last=False)
+        return response
+
+    def _resolve(self, path, params):
+        parts = [unquote(part) for part in path.strip('/').split('/') if part]
+        if parts == ['health']:
+            return 200, {'status': 'ok', 'cities': len(self.cities), 'cache': self.stats()}
+        if parts == ['cities']:
+            return 200, sorted(self.cities)
+        if len(parts) != 3 or parts[0] != 'cities':
+            return 404, {'error': f"Unknown path: {path}"}
+
+        city_name, name = parts[1], parts[2]
+        if city_name not in self.cities:
+            return 404, {'error': f"Unknown city: {city_name}"}
+        city = self.cities[city_name]
+        if name == 'neighbourhoods':
+            return 200, sorted(city['prices'])
+        if name not in aggregates:
+            return 404, {'error': f"Unknown aggregate: {name}. Choose one of {aggregates}"}
+
+        if 'neighbourhood' in params:
+            neighbourhood = params['neighbourhood'][0]
+            if neighbourhood not in city[name]:
+                return 404, {'error': f"No {name} for neighbourhood {neighbourhood} in {city_name}"}
+            return 200, city[name][neighbourhood]
+        return 200, [record for records in city[name].values() for record in records]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._responses)}
+
+
+def asgi_app(service):
+    """ASGI application serving a QueryService, e.g. for `uvicorn` or any other ASGI server."""
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['method'] not in ('GET', 'HEAD'):
+            status, body = 405, json.dumps({'error': 'Read-only service'}).encode()
+        else:
+            status, body = service.query(scope['path'], scope.get('query_string', b'').decode())
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body if scope['method'] == 'GET' else b''})
+    return app
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    """Threaded standard library HTTP server for a QueryService, so serving needs no extra dependency."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, body = service.query(url.path, url.query)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(workdir, cities=None, host='127.0.0.1', port=8000):
+    """
+    Serves the aggregates of the final data in a work directory until interrupted.
+
+    Args:
+    - workdir: Work directory of `python -m airbnb_backend run`, with one folder per city.
+    - cities: Cities to serve; by default every city with final data.
+    - host, port: Address to listen on. The default only accepts local connections.
+    """
+    server = make_server(QueryService(workdir, cities), host, port)
+    print(f"Serving on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,166 @@
+import functools
+import inspect
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .Data_Schema import apply_schema, attach_listing_text, memory_report, split_listing_text
+from .Instrumentation import instrumentation_enabled, instrumented, record_input_rows
+
+
+# Order in which the notebook runs the stages; a stage reading 'previous' gets the latest one stored before it
+stage_order = [
+    'calendar',
+    'listings',
+    'combined',
+    'categories',
+    'amenities',
+    'description_sentiment',
+    'review_sentiment',
+    'final',
+]
+
+# Stages with one row per listing; the others repeat each listing once per calendar month
+per_listing_stages = ['listings']
+
+
+def stage_path(workdir, stage):
+    """Path of the Parquet file holding the output of a stage in a per-city work directory."""
+    return os.path.join(workdir, f"{stage}.parquet")
+
+
+def listing_text_path(workdir, stage):
+    """Path of the side table holding the listing text columns of a per-month stage."""
+    return os.path.join(workdir, f"{stage}.listing_text.parquet")
+
+
+def has_stage(workdir, stage):
+    return os.path.exists(stage_path(workdir, stage))
+
+
+def _to_arrow_table(df):
+    """Convert a DataFrame to an Arrow table, casting object columns with mixed types to strings."""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = df.copy()
+        for col in df.select_dtypes(include=['object']):
+            try:
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def save_parquet(df, path):
+    """Write a DataFrame to a typed Parquet file, replacing any previous file atomically."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    pq.write_table(_to_arrow_table(df), temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_parquet(path):
+    """Read a Parquet file through a memory map, avoiding copies when converting to pandas where possible."""
+    table = pq.read_table(path, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+@instrumented
+def save_stage(df, workdir, stage):
+    """
+    Save a stage output. The listing text of per-month stages goes to a side table with one row per
+    listing instead of being repeated for every month.
+    """
+    listing_text = None
+    if stage not in per_listing_stages:
+        df, listing_text = split_listing_text(df)
+    if listing_text is not None:
+        save_parquet(listing_text, listing_text_path(workdir, stage))
+    elif os.path.exists(listing_text_path(workdir, stage)):
+        os.remove(listing_text_path(workdir, stage))
+    save_parquet(df, stage_path(workdir, stage))
+    print(f"Stage '{stage}' saved to {stage_path(workdir, stage)}")
+
+
+@instrumented
+def load_stage(workdir, stage):
+    df = load_parquet(stage_path(workdir, stage))
+    if os.path.exists(listing_text_path(workdir, stage)):
+        df = attach_listing_text(df, load_parquet(listing_text_path(workdir, stage)))
+    print(f"Stage '{stage}' loaded from {stage_path(workdir, stage)}")
+    return df
+
+
+def typed_stage_output(df, stage):
+    """
+    Apply the typed schema of Data_Schema to a stage output before it is stored. Its memory usage is only
+    reported while instrumentation is enabled, since the deep scan walks every object column.
+    """
+    df = apply_schema(df, text_dtype='string[pyarrow]' if stage in per_listing_stages else 'category')
+    if instrumentation_enabled():
+        memory_report(df, stage)
+    return df
+
+
+def latest_stage_before(workdir, stage):
+    """Return the most recent stored stage that runs before `stage`, or None if there is none."""
+    for previous in reversed(stage_order[:stage_order.index(stage)]):
+        if previous not in ('calendar', 'listings') and has_stage(workdir, previous):
+            return previous
+    return None
+
+
+def parquet_stage(stage, inputs=None):
+    """
+    Make a pipeline function restartable through a per-city Parquet work directory.
+
+    The decorated function gains three keyword arguments:
+    - workdir: Per-city work directory. When given, DataFrame inputs that are not passed are read from
+      the stored stages and the returned DataFrame is cast to the typed schema of Data_Schema and written
+      to '{workdir}/{stage}.parquet'. Without it the function runs unchanged.
+    - resume: If True and the stage output already exists in `workdir`, it is loaded instead of recomputed.
+    - input_stage: Stage read for 'previous' inputs instead of the latest stored one, e.g. the dependency
+      that actually ran in a pipeline, so stale files of skipped stages are never read.
+
+    Args:
+    - stage: Name of the stage output, one of `stage_order`.
+    - inputs: Dict mapping argument names to the stage they are read from. 'previous' reads the latest
+      stored stage that runs before this one.
+    """
+    inputs = inputs or {}
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, workdir=None, resume=False, input_stage=None, **kwargs):
+            if workdir is None:
+                return function(*args, **kwargs)
+
+            if resume and has_stage(workdir, stage):
+                return load_stage(workdir, stage)
+
+            # Load the DataFrame inputs that were not passed from the stored stages
+            bound = signature.bind_partial(*args, **kwargs)
+            for argument, argument_stage in inputs.items():
+                if bound.arguments.get(argument) is not None:
+                    continue
+                if argument_stage == 'previous':
+                    argument_stage = input_stage or latest_stage_before(workdir, stage)
+                    if argument_stage is None:
+                        raise FileNotFoundError(f"No stored stage before '{stage}' found in {workdir}")
+                bound.arguments[argument] = load_stage(workdir, argument_stage)
+                record_input_rows(bound.arguments[argument])
+
+            result = function(*bound.args, **bound.kwargs)
+            if isinstance(result, pd.DataFrame):
+                result = typed_stage_output(result, stage)
+                save_stage(result, workdir, stage)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,235 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# Vocabulary of the generated listings and reviews
+amenity_names = [
+    "Wifi", "Kitchen", "Heating", "Air conditioning", "Washer", "Dryer", "Hair dryer", "Iron", "Essentials",
+    "Hot water", "Dishes and silverware", "Refrigerator", "Microwave", "Coffee maker", "Oven", "Stove",
+    "Dedicated workspace", "TV", "Elevator", "Smoke alarm", "Carbon monoxide alarm", "Fire extinguisher",
+    "First aid kit", "Bed linens", "Extra pillows and blankets", "Hangers", "Shampoo", "Shower gel",
+    "Balcony", "Patio or balcony", "Free street parking", "Paid parking off premises", "Long term stays allowed",
+    "Self check-in", "Lockbox", "Crib", "High chair", "Dishwasher", "Pool", "Luggage dropoff allowed",
+]
+
+description_words = (
+    "bright spacious apartment flat studio loft room in the historic centre old town with balcony terrace "
+    "view close to metro station beach park fully equipped kitchen fast wifi air conditioning quiet street "
+    "perfect for couples families business travellers luxury design budget cosy charming renovated modern "
+    "elegant comfortable sunny large small private shared bathroom bedroom double bed sofa"
+).split()
+
+review_comments = [
+    "Great stay, the apartment was clean and the host was very helpful.",
+    "Nice place in a perfect location, would come back.",
+    "The flat was smaller than expected and a bit noisy at night.",
+    "Terrible experience, the room was dirty and the host never answered.",
+    "Excellent location, lovely view and everything we needed.",
+    "Ottima posizione e appartamento molto pulito.",
+    "Muy buena ubicación, el piso estaba limpio y cómodo.",
+    "Good value for money but the bed was uncomfortable.",
+    "Everything was fine.",
+    "Amazing host, beautiful home, highly recommended!",
+]
+
+room_types = ["Entire home/apt", "Private room", "Shared room", "Hotel room"]
+room_type_weights = [0.7, 0.26, 0.02, 0.02]
+
+host_names = ["Marco", "Giulia", "Ana", "João", "Carlos", "Laura", "Sofia", "Luca", "Maria", "Pedro"]
+
+# Labels of the tiny local stub models per pipeline task
+stub_labels = {
+    "sentiment-analysis": ["1 star", "2 stars", "3 stars", "4 stars", "5 stars"],
+    "zero-shot-classification": ["contradiction", "neutral", "entailment"],
+}
+
+# First day of the calendar of each of the four snapshots
+snapshot_starts = ['2023-06-15', '2023-09-15', '2023-12-15', '2024-03-15']
+
+
+def _format_prices(prices):
+    return pd.Series(prices).map('${:,.2f}'.format).to_numpy(dtype=object)
+
+
+def _make_listings(listings, neighbourhoods, rng):
+    """Per-listing attributes that stay the same across the snapshots."""
+    pool_size = int(listings * 1.1)
+    ids = np.sort(rng.choice(10 ** 18, size=pool_size, replace=False)) + 1000
+
+    # Neighbourhood sizes follow a Zipf-like distribution, as in real cities
+    weights = 1.0 / np.arange(1, neighbourhoods + 1)
+    neighbourhood_names = np.array([f"Neighbourhood {k + 1}" for k in range(neighbourhoods)], dtype=object)
+
+    # Many hosts copy their descriptions, so a fifth of the listings share a few hundred texts
+    word_counts = rng.integers(8, 120, size=pool_size)
+    descriptions = np.array([' '.join(rng.choice(description_words, size=count)) for count in word_counts], dtype=object)
+    shared = rng.random(pool_size) < 0.2
+    descriptions[shared] = descriptions[rng.integers(0, max(pool_size // 100, 1), size=shared.sum())]
+    descriptions[rng.random(pool_size) < 0.05] = None
+
+    amenity_counts = rng.integers(3, 25, size=pool_size)
+    amenities = np.array([
+        '[' + ', '.join(f'"{name}"' for name in rng.choice(amenity_names, size=count, replace=False)) + ']'
+        for count in amenity_counts
+    ], dtype=object)
+
+    return pd.DataFrame({
+        'id': ids,
+        'name': [f"Rental unit {k}" for k in range(pool_size)],
+        'host_id': rng.integers(10 ** 6, 10 ** 9, size=max(pool_size // 3, 1))[rng.integers(0, max(pool_size // 3, 1), size=pool_size)],
+        'host_name': rng.choice(host_names, size=pool_size),
+        'neighbourhood_cleansed': neighbourhood_names[rng.choice(neighbourhoods, size=pool_size, p=weights / weights.sum())],
+        'latitude': (41.9 + rng.normal(0, 0.03, size=pool_size)).round(5),
+        'longitude': (12.5 + rng.normal(0, 0.03, size=pool_size)).round(5),
+        'room_type': rng.choice(room_types, size=pool_size, p=room_type_weights),
+        'base_price': np.exp(rng.normal(4.7, 0.6, size=pool_size)).round(),
+        'description': descriptions,
+        'amenities': amenities,
+        'review_scores_rating': rng.uniform(3.5, 5.0, size=pool_size).round(2),
+        'accommodates': rng.integers(1, 9, size=pool_size),
+    })
+
+
+def generate_city(city_name, output_dir, listings=10_000, neighbourhoods=30, calendar_days=365,
+                  reviews_per_listing=5, seed=0):
+    """
+    Writes a synthetic city in the layout of the real inputs: 'calendar_{city}{i}.csv',
+    '{city}_listings{i}.csv', '{city}_listings{i}_long.csv' and '{city}_reviews{i}.csv' for four snapshots.
+
+    Each snapshot holds `listings` listings drawn from a slightly larger pool, so listings appear and
+    disappear between snapshots, and a calendar of `calendar_days` days per listing. The calendar files
+    grow with listings x calendar_days; lower calendar_days for the largest scales.
+
+    Args:
+    - city_name: Name used in the file names.
+    - output_dir: Directory the CSV files are written to.
+    - listings: Number of listings per snapshot (the real cities have 10k-500k).
+    - neighbourhoods: Number of neighbourhoods.
+    - calendar_days: Number of calendar days per listing and snapshot.
+    - reviews_per_listing: Mean number of reviews per listing and snapshot.
+    - seed: Random seed; the same arguments always write the same files.
+
+    Returns:
+    - output_dir: The directory holding the files.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    pool = _make_listings(listings, neighbourhoods, rng)
+
+    for i, start in enumerate(snapshot_starts, start=1):
+        snapshot = pool.iloc[np.sort(rng.choice(len(pool), size=listings, replace=False))].reset_index(drop=True)
+        prices = (snapshot['base_price'] * (1 + 0.03 * (i - 1)) * rng.uniform(0.9, 1.1, size=listings)).round()
+        number_of_reviews = rng.poisson(reviews_per_listing * 4, size=listings)
+        has_reviews = number_of_reviews > 0
+
+        listing_prices = _format_prices(prices)
+        listing_prices[rng.random(listings) < 0.03] = None
+        pd.DataFrame({
+            'id': snapshot['id'],
+            'name': snapshot['name'],
+            'host_id': snapshot['host_id'],
+            'host_name': snapshot['host_name'],
+            'neighbourhood_group': None,
+            'neighbourhood': snapshot['neighbourhood_cleansed'],
+            'latitude': snapshot['latitude'],
+            'longitude': snapshot['longitude'],
+            'room_type': snapshot['room_type'],
+            'price': listing_prices,
+            'minimum_nights': rng.choice([1, 2, 3, 7, 30], size=listings),
+            'number_of_reviews': number_of_reviews,
+            'last_review': np.where(has_reviews, '2024-02-01', None),
+            'reviews_per_month': np.where(has_reviews, (number_of_reviews / 12).round(2), np.nan),
+            'calculated_host_listings_count': rng.integers(1, 10, size=listings),
+            'availability_365': rng.integers(0, 366, size=listings),
+            'number_of_reviews_ltm': (number_of_reviews * 0.4).astype(int),
+            'license': None,
+        }).to_csv(os.path.join(output_dir, f"{city_name}_listings{i}.csv"), index=False)
+
+        pd.DataFrame({
+            'id': snapshot['id'],
+            'listing_url': 'https://www.airbnb.com/rooms/' + snapshot['id'].astype(str),
+            'name': snapshot['name'],
+            'description': snapshot['description'],
+            'host_id': snapshot['host_id'],
+            'host_name': snapshot['host_name'],
+            'host_total_listings_count': rng.integers(1, 20, size=listings),
+            'neighbourhood_cleansed': snapshot['neighbourhood_cleansed'],
+            'latitude': snapshot['latitude'],
+            'longitude': snapshot['longitude'],
+            'room_type': snapshot['room_type'],
+            'accommodates': snapshot['accommodates'],
+            'amenities': snapshot['amenities'],
+            'price': listing_prices,
+            'number_of_reviews': number_of_reviews,
+            'review_scores_rating': np.where(has_reviews, snapshot['review_scores_rating'], np.nan),
+        }).to_csv(os.path.join(output_dir, f"{city_name}_listings{i}_long.csv"), index=False)
+
+        # One calendar row per listing and day, with daily prices around the listing price
+        days = pd.date_range(start, periods=calendar_days, freq='D').strftime('%Y-%m-%d').to_numpy(dtype=object)
+        daily_prices = _format_prices(np.unique(prices))
+        price_codes = np.searchsorted(np.unique(prices), prices)
+        rows = listings * calendar_days
+        pd.DataFrame({
+            'listing_id': np.repeat(snapshot['id'].to_numpy(), calendar_days),
+            'date': np.tile(days, listings),
+            'available': np.where(rng.random(rows) < 0.6, 't', 'f'),
+            'price': daily_prices[np.repeat(price_codes, calendar_days)],
+            'adjusted_price': None,
+            'minimum_nights': 1,
+            'maximum_nights': 365,
+        }).to_csv(os.path.join(output_dir, f"calendar_{city_name}{i}.csv"), index=False)
+
+        # Reviews of the previous year
+        review_counts = rng.poisson(reviews_per_listing, size=listings)
+        review_rows = int(review_counts.sum())
+        review_dates = pd.Timestamp('2023-07-01') + pd.to_timedelta(rng.integers(0, 366, size=review_rows), unit='D')
+        pd.DataFrame({
+            'listing_id': np.repeat(snapshot['id'].to_numpy(), review_counts),
+            'id': np.arange(review_rows) + i * 10 ** 12,
+            'date': review_dates.strftime('%Y-%m-%d'),
+            'reviewer_id': rng.integers(10 ** 6, 10 ** 9, size=review_rows),
+            'reviewer_name': rng.choice(host_names, size=review_rows),
+            'comments': rng.choice(review_comments, size=review_rows),
+        }).to_csv(os.path.join(output_dir, f"{city_name}_reviews{i}.csv"), index=False)
+
+        print(f"Snapshot {i} of {city_name}: {listings} listings, {rows} calendar rows, {review_rows} reviews")
+
+    return output_dir
+
+
+def build_stub_model(path, task="sentiment-analysis"):
+    """
+    Saves a tiny randomly initialized BERT classifier with the labels of `task`, so the NLP stages can run
+    offline, e.g. in benchmarks. Its predictions are meaningless.
+
+    Args:
+    - path: Directory the model and tokenizer are saved to.
+    - task: "sentiment-analysis" or "zero-shot-classification".
+
+    Returns:
+    - path: The model directory, usable as the model_name of the NLP stages.
+    """
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+    labels = stub_labels[task]
+    words = set(description_words) | {"this", "example", "is", "luxury", "standard", "economy"}
+    for comment in review_comments:
+        words.update(comment.lower().strip('.!').replace(',', '').split())
+    words.update('abcdefghijklmnopqrstuvwxyz0123456789.,!?')
+    vocabulary = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)
+
+    os.makedirs(path, exist_ok=True)
+    vocabulary_path = os.path.join(path, 'vocab.txt')
+    with open(vocabulary_path, 'w') as f:
+        f.write('\n'.join(vocabulary))
+
+    tokenizer = BertTokenizerFast(vocabulary_path, do_lower_case=True, model_max_length=512)
+    config = BertConfig(
+        vocab_size=len(vocabulary), hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=512,
+        id2label=dict(enumerate(labels)), label2id={label: i for i, label in enumerate(labels)},
+    )
+    BertForSequenceClassification(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
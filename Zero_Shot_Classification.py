@@ -1,49 +1,142 @@
+import time
+import numpy as np
 import pandas as pd
 import torch
-from transformers import pipeline
 from tqdm import tqdm
+from .Description_Dedup import deduplicate_texts
+from .Inference_Cache import get_inference_cache
+from .Instrumentation import instrumented
+from .Model_Registry import get_pipeline, model_key, zero_shot_model_name
+from .Stage_Store import parquet_stage
 
 
-def classify_property_descriptions(combined_data, batch_size=32):
+# Same hypothesis template as the transformers zero-shot pipeline
+hypothesis_template = "This example is {}."
+
+
+def classify_texts(texts, classifier, candidate_labels, batch_size=32, max_length=512):
+    """
+    Zero-shot classifies texts by batching premise x hypothesis pairs directly through the NLI model.
+
+    The hypotheses are tokenized once for all texts, the premises once each, and the texts are sorted by
+    token length so that every batch holds similarly long pairs and little padding.
+
+    Args:
+    - texts: List of texts to classify.
+    - classifier: A zero-shot-classification pipeline, used for its model, tokenizer and entailment id.
+    - candidate_labels: List of labels; the label with the highest entailment logit wins.
+    - batch_size: Number of texts per forward pass (each text adds one pair per label).
+    - max_length: Maximum number of tokens of a premise x hypothesis pair.
+
+    Returns:
+    - labels: List with the best label of each text.
+    """
+    if len(texts) == 0:
+        return []
+
+    tokenizer = classifier.tokenizer
+    model = classifier.model
+    entailment_id = classifier.entailment_id
+    use_token_type_ids = 'token_type_ids' in tokenizer.model_input_names
+
+    # Tokenize the hypotheses once and the premises once, leaving room for the longest hypothesis
+    hypotheses = [
+        tokenizer(hypothesis_template.format(label), add_special_tokens=False)['input_ids']
+        for label in candidate_labels
+    ]
+    max_premise_length = max_length - max(len(hypothesis) for hypothesis in hypotheses) - tokenizer.num_special_tokens_to_add(pair=True)
+    premises = tokenizer(list(texts), add_special_tokens=False, truncation=True, max_length=max_premise_length)['input_ids']
+
+    # Visit the texts from shortest to longest to minimize padding inside each batch
+    order = np.argsort([len(premise) for premise in premises], kind='stable')
+    best_labels = [None] * len(texts)
+
+    for i in tqdm(range(0, len(order), batch_size), desc="Processing Batches"):
+        batch_indices = order[i:i + batch_size]
+
+        # Build every premise x hypothesis pair from the already tokenized ids
+        features = []
+        for index in batch_indices:
+            for hypothesis in hypotheses:
+                feature = {'input_ids': tokenizer.build_inputs_with_special_tokens(premises[index], hypothesis)}
+                if use_token_type_ids:
+                    feature['token_type_ids'] = tokenizer.create_token_type_ids_from_sequences(premises[index], hypothesis)
+                features.append(feature)
+        inputs = tokenizer.pad(features, return_tensors='pt').to(model.device)
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            logits = model(**inputs).logits
+        if hasattr(classifier, 'record'):
+            classifier.record(len(batch_indices), time.perf_counter() - start)
+
+        # The label whose hypothesis is most entailed wins, as in the single-label pipeline
+        entailment = logits[:, entailment_id].reshape(len(batch_indices), len(candidate_labels))
+        for index, best in zip(batch_indices, entailment.argmax(dim=1).tolist()):
+            best_labels[index] = candidate_labels[best]
+
+    return best_labels
+
+
+@instrumented
+@parquet_stage('categories', inputs={'combined_data': 'previous'})
+def classify_property_descriptions(combined_data, batch_size=32, cache=None, backend="torch", model_name=None, dedup_threshold=None):
     """
     Classifies property descriptions into categories (Luxury, Standard, Economy) using a zero-shot classification model.
 
+    Every distinct description text is classified once, even when several listings share it, and the
+    result is mapped back to all rows.
+
     Args:
     - combined_data: The DataFrame containing property descriptions.
     - batch_size: The size of batches for processing descriptions.
+    - cache: Optional InferenceCache (or path to one); only descriptions missing from it are classified.
+    - backend: Inference backend, "torch", "torch-int8" or "onnx" (see Model_Registry.check_backend_agreement).
+    - model_name: Zero-shot model to use instead of the default one, e.g. a local stub model for benchmarks.
+    - dedup_threshold: If set, near-duplicate descriptions at this MinHash similarity are clustered and only one
+      description per cluster is classified; its category is given to the whole cluster (see Description_Dedup).
 
     Returns:
     - combined_data: The updated DataFrame with an added 'category' column.
     """
-    # Create a new DataFrame for processing
-    processed_data = combined_data.copy()
+    # Keep one entry per distinct description text
+    descriptions = combined_data['description'].dropna().astype(str)
+    unique_descriptions = descriptions.unique().tolist()
 
-    # Remove duplicate descriptions in the processed DataFrame
-    processed_data = processed_data.drop_duplicates(subset=['id', 'description'])
-
-    # Initialize the zero-shot classification pipeline with GPU if available
-    device = 0 if torch.cuda.is_available() else -1
-    classifier = pipeline("zero-shot-classification", model="joeddav/xlm-roberta-large-xnli", device=device)
+    # Get the shared zero-shot classification pipeline, loaded once per process (on GPU if available)
+    model_name = model_name or zero_shot_model_name
+    classifier = get_pipeline("zero-shot-classification", model_name, backend)
 
     # Define the candidate labels
     candidate_labels = ["Luxury", "Standard", "Economy"]
 
-    # Function to classify descriptions in batches
-    def classify_descriptions_batch(descriptions, batch_size=batch_size):
-        results = []
-        for i in tqdm(range(0, len(descriptions), batch_size), desc="Processing Batches"):
-            batch = descriptions[i:i+batch_size]
-            batch_results = classifier(batch, candidate_labels=candidate_labels)
-            results.extend([result['labels'][0] for result in batch_results])
-        return results
+    # Function to classify descriptions in length-bucketed batches
+    def classify_descriptions_batch(texts):
+        return classify_texts(texts, classifier, candidate_labels, batch_size=batch_size)
+
+    # Optionally classify one representative per cluster of near-duplicate descriptions
+    classified_descriptions, representative_of = unique_descriptions, None
+    if dedup_threshold is not None:
+        classified_descriptions, representative_of, _ = deduplicate_texts(unique_descriptions, dedup_threshold)
 
-    # Apply the classification to the processed dataset
-    processed_data['category'] = classify_descriptions_batch(processed_data['description'].tolist())
+    # Apply the classification to the distinct descriptions, skipping cached ones
+    start = time.perf_counter()
+    cache = get_inference_cache(cache)
+    if cache is None:
+        categories = classify_descriptions_batch(classified_descriptions)
+    else:
+        categories = cache.cached_map(classified_descriptions, classify_descriptions_batch, model_key(model_name, backend), "zero-shot-classification", candidate_labels)
+        print(f"Inference cache: {cache.stats()}")
+    elapsed = time.perf_counter() - start
+    print(f"Classified {len(classified_descriptions)} distinct descriptions for {len(combined_data)} rows "
+          f"in {elapsed:.1f} s ({len(classified_descriptions) / max(elapsed, 1e-9):.1f} descriptions/sec)")
 
-    # Keep only 'id', 'description', and 'category' columns in processed_data
-    processed_data = processed_data[['id', 'description', 'category']]
+    # Give every description the category of its representative
+    if representative_of is not None:
+        categories = [categories[representative] for representative in representative_of]
 
-    # Merge the 'category' column from processed_data into combined_data based on both 'id' and 'description'
-    combined_data = pd.merge(combined_data, processed_data[['id', 'description', 'category']], on=['id', 'description'], how='left')
+    # Map the category of each description back to every row
+    combined_data = combined_data.copy()
+    combined_data['category'] = descriptions.map(dict(zip(unique_descriptions, categories)))
 
     return combined_data
@@ -1,10 +1,18 @@
 # Importing modules from the package for easier access
-from .Arima import arima_forecast_and_save
-from .Load_Data import download_and_extract_city_data
+from .Arima import arima_forecast_and_save, backtest_forecast
+from .Load_Data import download_and_extract_city_data, fetch_cities, fetch_city
 from .Merge_Listings_Calendar_Data import prepare_combined_data
 from .Process_Calendar_Data import process_city_calender
 from .Process_Listing_Data import process_city_listings
-from .Processing_Amenities import process_combined_data
+from .Processing_Amenities import build_amenity_index, load_amenity_index, process_combined_data
 from .Sentiment_Analysis_Description import analyze_sentiment
 from .Sentiment_Analysis_Reviews import process_city_reviews
-from .Zero_Shot_Classification import classify_property_descriptions
\ No newline at end of file
+from .Zero_Shot_Classification import classify_property_descriptions
+from .Inference_Cache import InferenceCache
+from .Stage_Store import load_stage, save_stage
+from .Incremental_Refresh import refresh_city
+from .Model_Registry import check_backend_agreement, model_stats, prewarm, set_num_threads, unload
+from .Data_Schema import apply_schema, memory_report
+from .Instrumentation import disable_instrumentation, enable_instrumentation, read_instrumentation_log
+from .Serving import QueryService, serve
+from .Description_Dedup import deduplicate_texts
@@ -0,0 +1,77 @@
+import argparse
+import sys
+import time
+from .Arima import forecast_methods
+from .Hierarchical_Forecast import estimators
+from .Instrumentation import enable_instrumentation, profilers
+from .Model_Registry import backends, model_stats, set_num_threads
+from .Orchestrator import format_summary, run_cities
+from .Serving import serve
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m airbnb_backend', description='Airbnb backend data pipeline.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Build the final dataset of one or more cities.')
+    run_parser.add_argument('--cities', required=True, help='Comma-separated city names, e.g. rome,milan')
+    run_parser.add_argument('--workdir', required=True, help='Work directory for stage files and final data')
+    run_parser.add_argument('--jobs', type=int, default=1, help='Worker processes for CPU-bound stages')
+    run_parser.add_argument('--dataset-dir', default=None, help='Use already extracted CSV files instead of downloading')
+    run_parser.add_argument('--source', default=None, help="Mirror directory or URL with '{city}.zip' files instead of Google Drive")
+    run_parser.add_argument('--reviews', action='store_true', help='Also run the review sentiment stage')
+    run_parser.add_argument('--resume', action='store_true', help='Reuse stage outputs already in the work directory')
+    run_parser.add_argument('--cache', default=None, help='Path of the inference cache shared by the NLP stages')
+    run_parser.add_argument('--threads', type=int, default=None, help='PyTorch CPU threads for the NLP stages')
+    run_parser.add_argument('--backend', choices=backends, default='torch', help='Inference backend of the NLP stages')
+    run_parser.add_argument('--forecast-method', choices=forecast_methods, default='arima', help='Price forecasting method')
+    run_parser.add_argument('--forecast-estimator', choices=estimators, default='ses', help="Base estimator of the 'hierarchical' forecasting method")
+    run_parser.add_argument('--profile-log', default=None, help='Append per-stage timings, CPU, peak RSS and row counts to this JSON-lines file')
+    run_parser.add_argument('--profiler', choices=profilers, default=None, help='Also profile every stage (requires --profile-log)')
+    run_parser.add_argument('--chunksize', type=int, default=None, help='Stream calendar and review files in chunks of this many rows')
+    run_parser.add_argument('--dedup-threshold', type=float, default=None, help='Run the description models once per cluster of near-duplicate descriptions at this similarity, e.g. 0.9')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve aggregates of the final data over local HTTP.')
+    serve_parser.add_argument('--workdir', required=True, help='Work directory of a previous run')
+    serve_parser.add_argument('--cities', default=None, help='Comma-separated city names; by default every city with final data')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        cities = [city.strip().lower() for city in args.cities.split(',') if city.strip()] if args.cities else None
+        serve(args.workdir, cities, host=args.host, port=args.port)
+        return 0
+
+    if args.command == 'run':
+        cities = [city.strip().lower() for city in args.cities.split(',') if city.strip()]
+        if args.profile_log:
+            enable_instrumentation(args.profile_log, profiler=args.profiler)
+        if args.threads:
+            set_num_threads(args.threads)
+        start = time.perf_counter()
+        timings, failures = run_cities(
+            cities,
+            args.workdir,
+            jobs=args.jobs,
+            reviews=args.reviews,
+            dataset_dir=args.dataset_dir,
+            resume=args.resume,
+            cache=args.cache,
+            chunksize=args.chunksize,
+            backend=args.backend,
+            forecast_method=args.forecast_method,
+            source=args.source,
+            dedup_threshold=args.dedup_threshold,
+            forecast_estimator=args.forecast_estimator,
+        )
+        print(format_summary(timings, failures, cities))
+        for stats in model_stats():
+            print(f"Model {stats['model']} ({stats['backend']}): load {stats['load_seconds']:.1f} s, {stats['items']} items")
+        print(f"Wall time: {time.perf_counter() - start:.1f} s")
+        return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
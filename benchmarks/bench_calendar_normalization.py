@@ -0,0 +1,71 @@
+"""
+Benchmark of the calendar date/id normalization on a synthetic calendar.
+
+Compares the previous row-wise implementation (lambda month truncation, sort + drop_duplicates,
+int(float(x)) id parsing) with the vectorized one used by process_city_calender.
+
+Usage:
+    python benchmarks/bench_calendar_normalization.py --rows 10000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from airbnb_backend.Process_Calendar_Data import parse_listing_ids, truncate_to_month  # noqa: E402
+
+
+def make_calendar(rows, seed=0):
+    """Build a calendar frame shaped like the parsed calendar files: string ids and daily dates."""
+    rng = np.random.default_rng(seed)
+    n_listings = max(rows // 365, 1)
+    listing_ids = rng.integers(10_000, 10 ** 18, size=n_listings)
+    days = pd.date_range('2023-09-01', periods=365, freq='D').to_numpy()
+    return pd.DataFrame({
+        'listing_id': np.repeat(listing_ids, 365)[:rows].astype(str),
+        'date': np.tile(days, n_listings)[:rows],
+    })
+
+
+def legacy_normalization(calendar):
+    calendar = calendar.copy()
+    calendar['date'] = calendar['date'].apply(lambda x: x.replace(day=1))
+    calendar = calendar.sort_values(by=['listing_id', 'date'])
+    calendar = calendar.drop_duplicates(subset=['listing_id', 'date'])
+    calendar['listing_id'] = calendar['listing_id'].apply(lambda x: int(float(x)))
+    return calendar
+
+
+def vectorized_normalization(calendar):
+    calendar = calendar.copy()
+    calendar['date'] = truncate_to_month(calendar['date'])
+    calendar['listing_id'] = parse_listing_ids(calendar['listing_id'])
+    calendar = calendar.drop_duplicates(subset=['listing_id', 'date'])
+    return calendar.sort_values(by=['listing_id', 'date'], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    calendar = make_calendar(args.rows)
+    print(f"Synthetic calendar: {len(calendar)} rows")
+
+    timings = {}
+    outputs = {}
+    for name, function in [('legacy', legacy_normalization), ('vectorized', vectorized_normalization)]:
+        start = time.perf_counter()
+        outputs[name] = function(calendar)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>10}: {timings[name]:.2f} s ({len(outputs[name])} rows)")
+
+    print(f"Speedup: {timings['legacy'] / timings['vectorized']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
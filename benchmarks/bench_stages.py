@@ -0,0 +1,286 @@
+"""
+Timings of every pipeline stage on synthetic cities of several sizes.
+
+The synthetic CSV files (Synthetic_Data.generate_city) and the tiny stub NLP models are generated once
+per scale and kept in AIRBNB_BENCH_DIR (default: a folder in the system temp directory), so runs are
+offline and comparable. Scales and calendar length are set with AIRBNB_BENCH_LISTINGS (comma-separated)
+and AIRBNB_BENCH_CALENDAR_DAYS.
+
+The classes are an asv suite (see asv.conf.json at the repository root):
+    asv run --python=same
+The script also runs every stage once and prints a table, followed by the traced peak memory of the
+review join per listing and, for comparison, per review:
+    python benchmarks/bench_stages.py --listings 10000 --calendar-days 90
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from airbnb_backend.Arima import arima_forecast_and_save  # noqa: E402
+from airbnb_backend.Merge_Listings_Calendar_Data import prepare_combined_data  # noqa: E402
+from airbnb_backend.Process_Calendar_Data import process_city_calender  # noqa: E402
+from airbnb_backend.Process_Listing_Data import process_city_listings  # noqa: E402
+from airbnb_backend.Processing_Amenities import process_combined_data  # noqa: E402
+from airbnb_backend.Sentiment_Analysis_Reviews import _merge_review_sentiment  # noqa: E402
+from airbnb_backend.Stage_Store import has_stage, load_stage  # noqa: E402
+from airbnb_backend.Synthetic_Data import build_stub_model, generate_city  # noqa: E402
+
+city_name = 'bench'
+scales = [int(listings) for listings in os.environ.get('AIRBNB_BENCH_LISTINGS', '10000,100000').split(',')]
+calendar_days = int(os.environ.get('AIRBNB_BENCH_CALENDAR_DAYS', '90'))
+data_root = os.environ.get('AIRBNB_BENCH_DIR', os.path.join(tempfile.gettempdir(), 'airbnb_backend_bench'))
+
+# Listings of the NLP benchmarks, which are far slower per listing even with the stub models
+nlp_scales = [min(scale, 2000) for scale in scales[:1]]
+
+# Listings of the review join benchmarks; the per-review join grows with reviews times calendar months
+review_join_scales = scales[:1]
+
+
+def city_dir(listings, days=None):
+    """Directory of a generated city, created on first use. Holds 'raw' CSV files and stage files."""
+    days = days or calendar_days
+    directory = os.path.join(data_root, f"{listings}x{days}")
+    raw_dir = os.path.join(directory, 'raw')
+    if not os.path.exists(os.path.join(raw_dir, f"{city_name}_reviews4.csv")):
+        generate_city(city_name, raw_dir, listings=listings, calendar_days=days)
+    return directory
+
+
+def stub_model(task):
+    path = os.path.join(data_root, f"stub-{task}")
+    if not os.path.exists(os.path.join(path, 'config.json')):
+        build_stub_model(path, task)
+    return path
+
+
+def prepared_stage(listings, stage):
+    """Run the stages up to `stage` once per scale and return its output."""
+    directory = city_dir(listings)
+    raw_dir = os.path.join(directory, 'raw')
+    if not has_stage(directory, stage):
+        process_city_calender(city_name, raw_dir, workdir=directory, resume=True)
+        process_city_listings(city_name, raw_dir, workdir=directory, resume=True)
+        prepare_combined_data(workdir=directory, resume=True)
+        process_combined_data(None, workdir=directory, resume=True)
+    return load_stage(directory, stage)
+
+
+def review_scores(listings):
+    """Reviews of a generated city with a random sentiment score each, standing in for the model output."""
+    raw_dir = os.path.join(city_dir(listings), 'raw')
+    reviews = pd.concat([
+        pd.read_csv(os.path.join(raw_dir, f"{city_name}_reviews{i}.csv"), usecols=['listing_id'])
+        for i in range(1, 5)
+    ], ignore_index=True)
+    reviews['sentiment_score'] = np.random.default_rng(0).random(len(reviews))
+    return reviews
+
+
+def per_listing_join(combined_data, reviews):
+    """The review join of process_city_reviews: one averaged ranking per listing, joined many-to-one."""
+    average_sentiment = reviews.groupby('listing_id')['sentiment_score'].mean().rename('average_sentiment_score').reset_index()
+    return _merge_review_sentiment(combined_data, average_sentiment)
+
+
+def per_review_join(combined_data, reviews):
+    """The review join before it was reduced per listing: the ranking of every review, joined many-to-many."""
+    average = reviews['listing_id'].map(reviews.groupby('listing_id')['sentiment_score'].mean())
+    rankings = reviews[['listing_id']].assign(**{'Customer_Positivity_Ranking(1to5)': pd.cut(
+        average, bins=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0], labels=["1 star", "2 stars", "3 stars", "4 stars", "5 stars"],
+        include_lowest=True).astype(object)})
+    return pd.merge(combined_data, rankings, left_on='id', right_on='listing_id', how='left').drop(columns=['listing_id'])
+
+
+review_joins = {'per_listing': per_listing_join, 'per_review': per_review_join}
+
+
+def traced_peak_mb(function, *args):
+    """Peak memory in MB allocated by a call through Python and numpy, over what was allocated before it."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+
+class CalendarSuite:
+    params = scales
+    param_names = ['listings']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    def setup(self, listings):
+        self.raw_dir = os.path.join(city_dir(listings), 'raw')
+
+    def time_process_city_calender(self, listings):
+        process_city_calender(city_name, self.raw_dir)
+
+    def peakmem_process_city_calender(self, listings):
+        process_city_calender(city_name, self.raw_dir)
+
+
+class ListingsSuite:
+    params = scales
+    param_names = ['listings']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    def setup(self, listings):
+        self.raw_dir = os.path.join(city_dir(listings), 'raw')
+
+    def time_process_city_listings(self, listings):
+        process_city_listings(city_name, self.raw_dir)
+
+
+class MergeSuite:
+    params = scales
+    param_names = ['listings']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    def setup(self, listings):
+        self.calendar = prepared_stage(listings, 'calendar')
+        self.listings = prepared_stage(listings, 'listings')
+
+    def time_prepare_combined_data(self, listings):
+        prepare_combined_data(self.calendar, self.listings)
+
+    def peakmem_prepare_combined_data(self, listings):
+        prepare_combined_data(self.calendar, self.listings)
+
+
+class AmenitiesSuite:
+    params = scales
+    param_names = ['listings']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    def setup(self, listings):
+        self.combined_data = prepared_stage(listings, 'combined')
+
+    def time_process_combined_data(self, listings):
+        process_combined_data(self.combined_data)
+
+
+class ForecastSuite:
+    params = (scales, ['arima', 'hierarchical'])
+    param_names = ['listings', 'method']
+    timeout = 3600
+    number = 1
+    repeat = 1
+
+    def setup(self, listings, method):
+        self.combined_data = prepared_stage(listings, 'amenities')
+        self.output_dir = tempfile.mkdtemp()
+
+    def time_arima_forecast_and_save(self, listings, method):
+        arima_forecast_and_save(city_name, self.combined_data, output_dir=self.output_dir, output_formats=(), method=method)
+
+
+class ReviewJoinSuite:
+    """Memory of joining the review rankings to the combined data, per listing and per review."""
+    params = (review_join_scales, list(review_joins))
+    param_names = ['listings', 'join']
+    timeout = 3600
+    number = 1
+    repeat = 1
+
+    def setup(self, listings, join):
+        self.combined_data = prepared_stage(listings, 'combined')
+        self.reviews = review_scores(listings)
+
+    def peakmem_review_join(self, listings, join):
+        review_joins[join](self.combined_data, self.reviews)
+
+    def track_review_join_traced_peak(self, listings, join):
+        return traced_peak_mb(review_joins[join], self.combined_data, self.reviews)
+
+    track_review_join_traced_peak.unit = 'MB'
+
+
+class NlpSuite:
+    """NLP stages against tiny stub models: measures the pipeline around the model, not the model itself."""
+    params = nlp_scales
+    param_names = ['listings']
+    timeout = 3600
+    number = 1
+    repeat = 1
+
+    def setup(self, listings):
+        self.raw_dir = os.path.join(city_dir(listings), 'raw')
+        self.combined_data = prepared_stage(listings, 'combined')
+        self.sentiment_model = stub_model("sentiment-analysis")
+        self.zero_shot_model = stub_model("zero-shot-classification")
+
+    def time_classify_property_descriptions(self, listings):
+        from airbnb_backend.Zero_Shot_Classification import classify_property_descriptions
+        classify_property_descriptions(self.combined_data, model_name=self.zero_shot_model)
+
+    def time_analyze_sentiment(self, listings):
+        from airbnb_backend.Sentiment_Analysis_Description import analyze_sentiment
+        analyze_sentiment(self.combined_data, model_name=self.sentiment_model)
+
+    def time_process_city_reviews(self, listings):
+        from airbnb_backend.Sentiment_Analysis_Reviews import process_city_reviews
+        process_city_reviews(self.combined_data, city_name, dataset_dir=self.raw_dir, model_name=self.sentiment_model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--listings', type=int, default=10_000)
+    parser.add_argument('--calendar-days', type=int, default=calendar_days)
+    parser.add_argument('--nlp', action='store_true', help='Also time the NLP stages with stub models')
+    args = parser.parse_args()
+
+    directory = city_dir(args.listings, args.calendar_days)
+    raw_dir = os.path.join(directory, 'raw')
+    timings = {}
+
+    def timed(name, function, *function_args, **function_kwargs):
+        start = time.perf_counter()
+        result = function(*function_args, **function_kwargs)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    calendar = timed('process_city_calender', process_city_calender, city_name, raw_dir)
+    listings = timed('process_city_listings', process_city_listings, city_name, raw_dir)
+    combined_data = timed('prepare_combined_data', prepare_combined_data, calendar, listings)
+    combined_data = timed('process_combined_data', process_combined_data, combined_data)
+    if args.nlp:
+        from airbnb_backend.Sentiment_Analysis_Description import analyze_sentiment
+        from airbnb_backend.Sentiment_Analysis_Reviews import process_city_reviews
+        from airbnb_backend.Zero_Shot_Classification import classify_property_descriptions
+        nlp_data = combined_data[combined_data['id'].isin(combined_data['id'].unique()[:2000])]
+        timed('classify_property_descriptions', classify_property_descriptions, nlp_data, model_name=stub_model("zero-shot-classification"))
+        timed('analyze_sentiment', analyze_sentiment, nlp_data, model_name=stub_model("sentiment-analysis"))
+        timed('process_city_reviews', process_city_reviews, nlp_data, city_name, dataset_dir=raw_dir, model_name=stub_model("sentiment-analysis"))
+    output_dir = tempfile.mkdtemp()
+    for method in ('hierarchical', 'arima'):
+        timed(f'arima_forecast_and_save ({method})', arima_forecast_and_save, city_name, combined_data,
+              output_dir=output_dir, output_formats=(), method=method)
+
+    reviews = review_scores(args.listings)
+    peaks = {f"review join ({join})": traced_peak_mb(function, combined_data, reviews) for join, function in review_joins.items()}
+
+    print(f"\n{args.listings} listings x {args.calendar_days} calendar days, {len(reviews)} reviews")
+    width = max(len(name) for name in list(timings) + list(peaks))
+    for name, elapsed in timings.items():
+        print(f"{name:<{width}}  {elapsed:8.2f} s")
+    for name, peak in peaks.items():
+        print(f"{name:<{width}}  {peak:8.1f} MB peak")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Throughput of the zero-shot classification engine against the plain transformers pipeline.
+
+Both run on the same synthetic descriptions with widely varying lengths. The model defaults to the one
+used by classify_property_descriptions; pass --model with a local path to benchmark offline.
+
+Usage:
+    python benchmarks/bench_zero_shot.py --descriptions 500 --model joeddav/xlm-roberta-large-xnli
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from transformers import pipeline
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from airbnb_backend.Model_Registry import zero_shot_model_name  # noqa: E402
+from airbnb_backend.Zero_Shot_Classification import classify_texts  # noqa: E402
+
+candidate_labels = ["Luxury", "Standard", "Economy"]
+
+words = (
+    "bright spacious apartment in the historic centre with balcony terrace view of the old town "
+    "close to the metro station fully equipped kitchen fast wifi air conditioning quiet street "
+    "perfect for couples families and business travellers luxury design budget cosy studio"
+).split()
+
+
+def make_descriptions(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choices(words, k=rng.choice([8, 20, 60, 150, 300]))) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--descriptions', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--model', default=zero_shot_model_name)
+    args = parser.parse_args()
+
+    classifier = pipeline("zero-shot-classification", model=args.model, tokenizer=args.model, device=-1)
+    descriptions = make_descriptions(args.descriptions)
+
+    start = time.perf_counter()
+    reference = [result['labels'][0] for result in classifier(descriptions, candidate_labels=candidate_labels, batch_size=args.batch_size)]
+    pipeline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labels = classify_texts(descriptions, classifier, candidate_labels, batch_size=args.batch_size)
+    engine_seconds = time.perf_counter() - start
+
+    agreement = sum(a == b for a, b in zip(reference, labels)) / len(labels)
+    print(f"pipeline: {len(descriptions) / pipeline_seconds:.1f} descriptions/sec")
+    print(f"  engine: {len(descriptions) / engine_seconds:.1f} descriptions/sec")
+    print(f" speedup: {pipeline_seconds / engine_seconds:.2f}x, label agreement {agreement:.1%}")
+
+
+if __name__ == '__main__':
+    main()